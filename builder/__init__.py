@@ -1,3 +1,5 @@
+import collections
+
 from builder.roles import Roles
 
 # The default stack user name and password...
@@ -41,3 +43,69 @@ DEF_TOPO = {
 
 STACK_SH = '/home/%s/devstack/stack.sh' % DEF_USER
 STACK_SOURCE = 'git://git.openstack.org/openstack-dev/devstack'
+
+# Which roles must have finished running stack.sh before a role can
+# start running it (everything else may run stack.sh at the same time).
+#
+# These are the same as the old (one role group after another) ordering,
+# since each of them is needed: map servers create their databases and
+# queues on the db and rabbit servers, cap servers (child cells) register
+# with the parent cell (and keystone) on the map servers and nova-compute
+# on hypervisors waits on the conductor of its cell (on a cap server).
+STACK_SH_DEPENDS = {
+    Roles.MAP: (Roles.DB, Roles.RB),
+    Roles.CAP: (Roles.MAP, Roles.DB, Roles.RB),
+    Roles.HV: (Roles.CAP,),
+}
+
+# Rough (seconds) of how long stack.sh takes for each role, used to
+# run the longest chain of (remaining) stack.sh runs first.
+STACK_SH_DURATIONS = {
+    Roles.DB: 300,
+    Roles.RB: 300,
+    Roles.MAP: 900,
+    Roles.CAP: 900,
+    Roles.HV: 600,
+}
+
+# Installs the (distro) packages devstack needs; stack.sh skips doing
+# this itself if it was done recently, so servers that have to wait
+# for other servers run this while they wait.
+INSTALL_PREREQS = '/home/%s/devstack/tools/install_prereqs.sh' % DEF_USER
+
+# Where artifacts (bundles of files) are staged on servers when they are
+# broadcast (relayed from server to server) instead of uploaded to each.
+ARTIFACTS_DIR = '/home/%s/.builder/artifacts' % DEF_USER
+
+# Where (and on what branch) the locally prepared (cloned and patched)
+# devstack git bundle is put on servers (when shipping one).
+DEVSTACK_BUNDLE_DIR = '/home/%s/.builder' % DEF_USER
+DEVSTACK_BUNDLE_BRANCH = 'builder'
+
+# Where the (bare) mirrors of service git repos are kept (on one server)
+# when stack.sh is pointed at them (instead of at upstream).
+GIT_MIRROR_DIR = '/home/%s/.builder/mirror' % DEF_USER
+GIT_UPSTREAM = 'https://git.openstack.org'
+
+# Git repos (by name, with the devstack variable prefix that picks where
+# each is cloned from) that stack.sh clones when any of some services
+# (exact names, or service name prefixes ending with '-') are enabled
+# (repos without services are always cloned).
+GIT_REPOS = collections.OrderedDict([
+    ('requirements', ('REQUIREMENTS', ())),
+    ('keystone', ('KEYSTONE', ('key',))),
+    ('glance', ('GLANCE', ('glance', 'g-'))),
+    ('nova', ('NOVA', ('nova', 'n-'))),
+])
+
+# Where wheels (of what stack.sh pip installs) are built (on one server,
+# each set of them in a directory named by what they were built from)
+# and where each server keeps its copy (that pip is pointed at).
+WHEELS_DIR = '/home/%s/.builder/wheels' % DEF_USER
+WHEELHOUSE_DIR = '/home/%s/.builder/wheelhouse' % DEF_USER
+
+# Where the rpms (that get installed on servers) are downloaded to (on
+# one server) and served (over http, as a yum repo) from.
+PACKAGES_DIR = '/home/%s/.builder/packages' % DEF_USER
+PACKAGES_PORT = 8484
+PACKAGES_REPO = 'builder-packages'
@@ -8,74 +8,70 @@ import contextlib
 import hashlib
 import logging
 import os
-import pickle
 import sys
 import traceback
 
 sys.path.insert(0, os.path.join(os.path.abspath(os.pardir)))
 sys.path.insert(0, os.path.abspath(os.getcwd()))
 
-import shade
-
 from builder import cows
 from builder import creator
+from builder import daemon
 from builder import destroyer
 from builder import pprint
+from builder import simulate
+from builder import storage
 from builder import utils
 
 TRACE = 5
 
 
-def make_saver(path, clouds):
+def non_neg_float(val):
+    f_val = float(val)
+    if f_val < 0:
+        msg = "%s is not a non-negative number" % val
+        raise argparse.ArgumentTypeError(msg)
+    return f_val
 
-    def saver():
-        # Doing this ensures we perform this in a crash safe
-        # manner, so that even if we get interrupted while saving the
-        # original file is not messed up.
-        tmp_path = "%s.tmp" % path
-        with open(tmp_path, 'wb') as fh:
-            fh.write(pickle.dumps(clouds, -1))
-        os.rename(tmp_path, path)
 
-    return saver
+def pos_float(val):
+    f_val = float(val)
+    if f_val <= 0:
+        msg = "%s is not a positive number" % val
+        raise argparse.ArgumentTypeError(msg)
+    return f_val
 
 
 @contextlib.contextmanager
-def fetch_tracker(path, cloud_name):
-    needs_save = False
-    try:
-        with open(path, 'rb') as fh:
-            fh_contents = fh.read()
-            if fh_contents:
-                clouds = pickle.loads(fh_contents)
-            else:
-                clouds = {}
-                needs_save = True
-    except IOError as e:
-        if e.errno == errno.ENOENT:
-            clouds = {}
-            needs_save = True
-        else:
-            raise
-    saver = make_saver(path, clouds)
-    if needs_save:
-        saver()
+def fetch_tracker(path, cloud_name, state_format='pickle', sync_delay=0.0):
+    # Other processes may be using the same state (for other clouds) which
+    # is fine, but two processes working on the same cloud is not.
+    cloud_lock = storage.FileLock("%s.%s.lock" % (path, cloud_name))
+    if not cloud_lock.acquire(blocking=False):
+        raise RuntimeError("State for cloud '%s' in '%s' is already in use"
+                           " by another process" % (cloud_name, path))
+    store = storage.open_store(path, kind=state_format)
     try:
-        cloud = clouds[cloud_name]
-    except KeyError:
-        clouds[cloud_name] = cloud = {}
-        saver()
-    try:
-        yield utils.Tracker(cloud, saver)
+        clouds = store.load()
+        try:
+            cloud = clouds[cloud_name]
+        except KeyError:
+            clouds[cloud_name] = cloud = {}
+        saver = store.make_saver(cloud_name, cloud)
+        tracker = utils.Tracker(cloud, saver, delay=sync_delay)
+        tracker.flush()
+        try:
+            yield tracker
+        finally:
+            tracker.close()
     finally:
-        saver()
+        try:
+            store.close()
+        finally:
+            cloud_lock.release()
 
 
-def main():
-    if 'PROGRAM_NAME' in os.environ:
-        prog_name = os.path.basename(os.getenv("PROGRAM_NAME"))
-    else:
-        prog_name = None
+def make_parser(prog_name=None):
     parser = argparse.ArgumentParser(prog=prog_name)
     parser.add_argument("--cloud",
                         help="specific os-client-config cloud to"
@@ -87,9 +83,46 @@ def main():
                         metavar="REGION")
     parser.add_argument("--state",
                         help="file to read/write action state"
-                             " information into/from (default=%(default)s)",
-                        default=os.path.join(os.getcwd(), "state.pkl"),
-                        metavar="PATH")
+                             " information into/from (default=state.EXT in"
+                             " the current working directory, where EXT"
+                             " depends on the state format)",
+                        default=None, metavar="PATH")
+    parser.add_argument("--state-format",
+                        help="format used to persist action state"
+                             " information (default=%(default)s)",
+                        choices=sorted(storage.STORES.keys()),
+                        default='pickle')
+    parser.add_argument("--state-sync-delay",
+                        help="seconds to coalesce action state saves"
+                             " for, zero disables write-behind saving"
+                             " (default=%(default)s)",
+                        default=0.05, type=non_neg_float,
+                        metavar="SECONDS")
+    parser.add_argument("--simulate",
+                        help="run against a simulated cloud (and simulated"
+                             " servers) instead of a real one, reporting"
+                             " the predicted wall time of each stage",
+                        action='store_true', default=False)
+    parser.add_argument("--simulate-latencies",
+                        help="json file of operation names to [mean,"
+                             " stddev] seconds that simulated operations"
+                             " take (overriding the defaults)",
+                        default=None, metavar="PATH")
+    parser.add_argument("--simulate-speedup",
+                        help="how many times faster than real time"
+                             " simulated time runs (default=%(default)s)",
+                        default=100.0, type=pos_float,
+                        metavar="FACTOR")
+    parser.add_argument("--daemon",
+                        help="run the sub-command through a (already"
+                             " running) daemon, which keeps its cloud,"
+                             " state and ssh connections between commands",
+                        action='store_true', default=False)
+    parser.add_argument("--daemon-socket",
+                        help="unix socket the daemon listens on"
+                             " (default=the state path with '.sock'"
+                             " appended)",
+                        default=None, metavar="PATH")
     parser.add_argument("-v", "--verbose",
                         help=("run in verbose mode (may be specified more"
                               " than once to increase the verbosity)"),
@@ -98,10 +131,38 @@ def main():
     subparsers = parser.add_subparsers(help='sub-command help')
     destroyer.bind_subparser(subparsers)
     creator.bind_subparser(subparsers)
+    daemon.bind_subparser(subparsers)
+    return parser
 
-    args = parser.parse_args()
+
+def finish_args(args):
+    if not args.state:
+        args.state = os.path.join(
+            os.getcwd(),
+            "state.%s" % storage.STORE_EXTENSIONS[args.state_format])
     args = creator.post_process_args(args)
     args = destroyer.post_process_args(args)
+    args = daemon.post_process_args(args)
+    return args
+
+
+def main():
+    if 'PROGRAM_NAME' in os.environ:
+        prog_name = os.path.basename(os.getenv("PROGRAM_NAME"))
+    else:
+        prog_name = None
+    parser = make_parser(prog_name=prog_name)
+    args = finish_args(parser.parse_args())
+    if args.daemon and args.func is not daemon.serve:
+        # The daemon does everything (and we just show what it outputs).
+        try:
+            sys.exit(daemon.run_client(args.daemon_socket, sys.argv[1:]))
+        except IOError as e:
+            print(e)
+            sys.exit(1)
+    # So that a daemon can parse (and finish) the commands it is sent.
+    args.parser = parser
+    args.finish_args = finish_args
     if args.verbose == 1:
         logging.basicConfig(level=logging.INFO)
     elif args.verbose == 2:
@@ -114,8 +175,20 @@ def main():
         # No options provided...
         logging.basicConfig(level=logging.WARN)
     try:
-        cloud = shade.openstack_cloud(cloud=args.cloud,
-                                      region_name=args.cloud_region)
+        if args.simulate:
+            cloud = simulate.make_cloud(
+                args.state, latencies_path=args.simulate_latencies,
+                speedup=args.simulate_speedup)
+            args.connector = cloud.connect
+            args.clock = cloud.latencies.clock
+        else:
+            # Imported here since clients of a daemon do not need it (and
+            # importing it is not quick).
+            import shade
+            cloud = shade.openstack_cloud(cloud=args.cloud,
+                                          region_name=args.cloud_region)
+            args.connector = utils.ssh_connect
+            args.clock = utils.now
         cloud_name_chunks = [cloud.auth['auth_url']]
         if cloud.region_name:
             cloud_name_chunks.append(cloud.region_name)
@@ -125,9 +198,11 @@ def main():
         for piece in cloud_name_chunks:
             cloud_hasher.update(piece)
         cloud_name = cloud_hasher.hexdigest()
-        with fetch_tracker(args.state, cloud_name) as tracker:
+        with fetch_tracker(args.state, cloud_name,
+                           state_format=args.state_format,
+                           sync_delay=args.state_sync_delay) as tracker:
             print("Action: '%s'" % args.func.__doc__)
-            print("State: '%s'" % args.state)
+            print("State: '%s' (%s)" % (args.state, args.state_format))
             print("Tracker name: '%s'" % cloud_name)
             print("Cloud:")
             pretty_cloud = collections.OrderedDict([
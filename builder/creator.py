@@ -1,25 +1,32 @@
 from __future__ import print_function
 
 import argparse
+import collections
 import copy
 import functools
+import hashlib
 import itertools
 import json
 import multiprocessing
 import os
 import random
+import shutil
+import tempfile
+import threading
 
-import futurist
 import jinja2
-import munch
-from oslo_utils import reflection
-import plumbum
+from plumbum import local
 import six
 
 import builder
 from builder import images
+from builder import pipeline
 from builder import pprint
+from builder import scripts
+from builder import servers as sv
+from builder import simulate
 from builder import states as st
+from builder import transfer
 from builder import utils
 
 from builder.roles import Roles
@@ -30,17 +37,34 @@ DEF_PW = builder.DEF_PW
 DEF_FLAVORS = builder.DEF_FLAVORS
 DEF_TOPO = builder.DEF_TOPO
 STACK_SH = builder.STACK_SH
+STACK_SH_DEPENDS = builder.STACK_SH_DEPENDS
+STACK_SH_DURATIONS = builder.STACK_SH_DURATIONS
+INSTALL_PREREQS = builder.INSTALL_PREREQS
+ARTIFACTS_DIR = builder.ARTIFACTS_DIR
+DEVSTACK_BUNDLE_DIR = builder.DEVSTACK_BUNDLE_DIR
+DEVSTACK_BUNDLE_BRANCH = builder.DEVSTACK_BUNDLE_BRANCH
+GIT_MIRROR_DIR = builder.GIT_MIRROR_DIR
+GIT_UPSTREAM = builder.GIT_UPSTREAM
+GIT_REPOS = builder.GIT_REPOS
+WHEELS_DIR = builder.WHEELS_DIR
+WHEELHOUSE_DIR = builder.WHEELHOUSE_DIR
 STACK_SOURCE = builder.STACK_SOURCE
-SERVER_RETAIN_KEYS = tuple([
-    'kind',
-    'name',
-    'builder_state',
-    'filled',
-    'image',
-    'flavor',
-    'availability_zone',
-    'userdata',
-])
+PACKAGES_DIR = builder.PACKAGES_DIR
+PACKAGES_PORT = builder.PACKAGES_PORT
+PACKAGES_REPO = builder.PACKAGES_REPO
+
+# Packages installed (ahead of stack.sh) on each server.
+SOME_PACKAGES = (
+    # We need to get the mariadb package (the client) installed
+    # so that future runs of stack.sh which will not install the
+    # mariadb-server will be able to interact with the database,
+    #
+    # Otherwise it ends badly at stack.sh run-time... (maybe
+    # something we can fix in devstack?)
+    'mariadb',
+    # This is wanted for our overlay (eventually),
+    'openvswitch',
+)
 
 
 def pos_int(val):
@@ -51,6 +75,14 @@ def pos_int(val):
     return i_val
 
 
+def non_neg_int(val):
+    i_val = int(val)
+    if i_val < 0:
+        msg = "%s is not a non-negative integer" % val
+        raise argparse.ArgumentTypeError(msg)
+    return i_val
+
+
 def post_process_args(args):
     if hasattr(args, 'templates'):
         args.template_fetcher = jinja2.Environment(
@@ -122,6 +154,54 @@ def bind_subparser(subparsers):
                                      " directory (default=%(default)s)"),
                                default=os.path.join(os.getcwd(), "repos.d"),
                                metavar="PATH")
+    parser_create.add_argument("--verify-uploads",
+                               help=("check (with a single sha256sum per"
+                                     " stage) that files already uploaded"
+                                     " (as recorded in the action state)"
+                                     " are still there (and unchanged)"
+                                     " before skipping them"),
+                               default=False, action='store_true')
+    parser_create.add_argument("--devstack-bundle",
+                               help=("clone (into a local mirror) and patch"
+                                     " devstack once (here) and ship the"
+                                     " result as a git bundle, instead of"
+                                     " cloning and patching it on every"
+                                     " server"),
+                               default=False, action='store_true')
+    parser_create.add_argument("--devstack-mirror",
+                               help=("local devstack git mirror (reused"
+                                     " across runs) used when shipping a"
+                                     " devstack bundle (default=%(default)s)"),
+                               default=os.path.join(os.getcwd(),
+                                                    "devstack.git"),
+                               metavar="PATH")
+    parser_create.add_argument("--git-mirror",
+                               help=("mirror the git repos stack.sh clones"
+                                     " (from upstream) onto a single server"
+                                     " and seed every servers /opt/stack"
+                                     " (and point stack.sh) at that mirror"),
+                               default=False, action='store_true')
+    parser_create.add_argument("--package-cache",
+                               help=("download the rpms servers install"
+                                     " once (on a single server) and have"
+                                     " yum on every server install them"
+                                     " from there"),
+                               default=False, action='store_true')
+    parser_create.add_argument("--wheelhouse",
+                               help=("build wheels (of what stack.sh pip"
+                                     " installs) once on a single server"
+                                     " and have pip on every server find"
+                                     " them there first"),
+                               default=False, action='store_true')
+    parser_create.add_argument("--broadcast-fanout",
+                               help=("upload repos.d, patches and extras.d"
+                                     " files to a single server and have"
+                                     " servers relay them (over ssh) to"
+                                     " this many others each, instead of"
+                                     " uploading them to every server"
+                                     " (zero disables) (default=%(default)s)"),
+                               default=0, type=non_neg_int,
+                               metavar='NUMBER')
     parser_create.set_defaults(func=create)
     return parser_create
 
@@ -163,83 +243,143 @@ def make_az_selector(azs):
     return az_selector
 
 
-def merge_servers(master_server, server):
-    """Merges new server data into master server (minus certain keys)."""
-    for k in server.keys():
-        if k not in SERVER_RETAIN_KEYS:
-            master_server[k] = server[k]
-
-
 def setup_git(args, helper, server, indent='', last_result=None):
     """Performs initial git setup/config on a server."""
     machine = helper.machines[server.name]
     creator = helper.cloud.auth['username']
-    git_path = machine.path(".git")
-    if not git_path.is_dir():
-        git_path.mkdir()
-    git_config_path = machine.path(".gitconfig")
-    if not git_config_path.is_file():
-        git_config_path.touch()
-    git = machine['git']
-    try:
-        user_email = git("config", "--global", "--get", 'user.email')
-        user_email = user_email.strip()
-    except plumbum.ProcessExecutionError:
-        user_email = None
-    if not user_email:
-        git("config", "--global", "user.email",
-            "%s@%s.com" % (creator, creator))
-    try:
-        user_name = git("config", "--global", "--get", 'user.name')
-        user_name = user_name.strip()
-    except plumbum.ProcessExecutionError:
-        user_name = None
-    if not user_name:
-        git("config", "--global", "user.name", "Mr/mrs. %s" % creator)
+    script = scripts.Script()
+    script.add('git_dir', "mkdir -p .git")
+    script.add('git_config', "touch .gitconfig")
+    for key, value in [('user.email', "%s@%s.com" % (creator, creator)),
+                       ('user.name', "Mr/mrs. %s" % creator)]:
+        script.add(key.replace(".", "_"),
+                   "git config --global --get %s >/dev/null ||"
+                   " git config --global %s %s"
+                   % (key, key, six.moves.shlex_quote(value)))
+    script.run(machine)
+
+
+def stack_chain_lengths(depends, durations):
+    """Returns how long the longest chain of stack.sh runs from each role is.
+
+    This is the role's own (rough) duration plus the longest chain of
+    the roles that depend on it (directly or indirectly).
+    """
+    dependents = collections.defaultdict(set)
+    for kind, kind_depends in six.iteritems(depends):
+        for dep_kind in kind_depends:
+            dependents[dep_kind].add(kind)
+    lengths = {}
+
+    def chain_length(kind):
+        if kind not in lengths:
+            lengths[kind] = durations.get(kind, 0) + max(
+                [chain_length(other) for other in dependents[kind]] or [0])
+        return lengths[kind]
+
+    for kind in Roles:
+        chain_length(kind)
+    return lengths
+
+
+def stack_all_depends(depends, kind):
+    """Returns all the roles a role depends on (directly or indirectly)."""
+    all_depends = set()
+    to_visit = list(depends.get(kind, ()))
+    while to_visit:
+        dep_kind = to_visit.pop()
+        if dep_kind not in all_depends:
+            all_depends.add(dep_kind)
+            to_visit.extend(depends.get(dep_kind, ()))
+    return all_depends
 
 
 def run_stack(args, helper, indent=""):
 
     def on_stack_done(remote_cmd, index):
-        server = remote_cmd.server
-        server.builder_state = st.STACK_SH_END
-        helper.save_topo()
+        helper.set_server_state(remote_cmd.server, st.STACK_SH_END)
 
     def on_stack_start(remote_cmd, index):
-        server = remote_cmd.server
-        server.builder_state = st.STACK_SH_START
-        helper.save_topo()
+        helper.set_server_state(remote_cmd.server, st.STACK_SH_START)
+        # Stack.sh is not idempotent, so this must not be left unsaved
+        # (waiting on a write-behind save) while it runs.
+        helper.tracker.flush()
 
-    run_stack_order = [
-        [Roles.RB, Roles.DB], [Roles.MAP], [Roles.CAP], [Roles.HV],
-    ]
-    for group in run_stack_order:
-        possible_servers = []
-        for kind in group:
-            for server in helper.iter_server_by_kind(kind):
-                if server.builder_state < st.STACK_SH_END:
-                    possible_servers.append(server)
-                else:
-                    print("%sSkipping server %s because it has"
-                          " already finishing running"
-                          " stack.sh" % (indent, server.name))
-        if not possible_servers:
-            continue
-        run_cmds = []
-        for server in possible_servers:
-            if server.builder_state == st.STACK_SH_START:
-                print("%sWARNING: Server %s already started running `%s` this"
-                      " may not end well as stack.sh is not"
-                      " idempotent..." % (indent, server.name, STACK_SH))
-            machine = helper.machines[server.name]
-            run_cmds.append(utils.RemoteCommand(machine[STACK_SH],
-                                                scratch_dir=args.scratch_dir,
-                                                server=server))
-        max_workers = min(args.max_workers, len(run_cmds))
-        utils.run_and_record(run_cmds, verbose=args.verbose,
-                             max_workers=max_workers, indent=indent,
-                             on_start=on_stack_start,
-                             on_done=on_stack_done)
+    def make_runner(remote_cmd, **kwargs):
+        return functools.partial(utils.run_and_record, [remote_cmd],
+                                 verbose=args.verbose, max_workers=1,
+                                 indent=indent, recorder=helper.recorder,
+                                 **kwargs)
+
+    def make_prereq_runner(remote_cmd):
+        runner = make_runner(remote_cmd)
+
+        def prereq_runner():
+            # Not fatal, stack.sh will just (re)try installing them...
+            try:
+                runner()
+            except utils.RemoteExecutionFailed as e:
+                print("%sWARNING: %s failed (stack.sh will retry"
+                      " it): %s" % (indent, remote_cmd, e))
+
+        return prereq_runner
+
+    possible_servers = []
+    for server in helper.iter_servers():
+        if server.builder_state < st.STACK_SH_END:
+            possible_servers.append(server)
+        else:
+            print("%sSkipping server %s because it has"
+                  " already finishing running"
+                  " stack.sh" % (indent, server.name))
+    if not possible_servers:
+        return
+    chain_lengths = stack_chain_lengths(STACK_SH_DEPENDS, STACK_SH_DURATIONS)
+    stack_tasks = collections.defaultdict(list)
+    for server in possible_servers:
+        stack_tasks[server.kind].append("stack:%s" % server.name)
+    # Each server runs stack.sh as soon as the servers (with roles) it
+    # depends on have finished running it, those with the longest chain
+    # of servers waiting on them go first; servers that have to wait
+    # install devstack's prerequisites while they wait.
+    sched = pipeline.Scheduler(args.max_workers)
+    for server in possible_servers:
+        if server.builder_state == st.STACK_SH_START:
+            print("%sWARNING: Server %s already started running `%s` this"
+                  " may not end well as stack.sh is not"
+                  " idempotent..." % (indent, server.name, STACK_SH))
+        machine = helper.machines[server.name]
+        requires = set()
+        for dep_kind in stack_all_depends(STACK_SH_DEPENDS, server.kind):
+            requires.update(stack_tasks[dep_kind])
+        priority = chain_lengths[server.kind]
+        if requires and server.builder_state < st.STACK_SH_START:
+            prereq_name = "prereqs:%s" % server.name
+            prereq_cmd = utils.RemoteCommand(machine[INSTALL_PREREQS],
+                                             scratch_dir=args.scratch_dir,
+                                             server=server)
+            sched.add(pipeline.Task(prereq_name,
+                                    make_prereq_runner(prereq_cmd),
+                                    priority=priority))
+            requires.add(prereq_name)
+            print("%sServer %s will run `%s` while waiting on %s" % (
+                indent, server.name, INSTALL_PREREQS,
+                ", ".join(sorted(name.split(":", 1)[1]
+                                 for name in requires
+                                 if name.startswith("stack:")))))
+        stack_cmd = utils.RemoteCommand(machine[STACK_SH],
+                                        scratch_dir=args.scratch_dir,
+                                        server=server)
+        sched.add(pipeline.Task("stack:%s" % server.name,
+                                make_runner(stack_cmd,
+                                            on_start=on_stack_start,
+                                            on_done=on_stack_done),
+                                requires=requires, priority=priority))
+    try:
+        not_ran = sched.run()
+    finally:
+        helper.tracker.flush()
+    pipeline.check_failures(sched, not_ran)
 
 
 def create_overlay(args, helper, indent=''):
@@ -258,58 +398,127 @@ def output_cloud(args, helper, indent=''):
     print("The password: %s" % helper.settings['ADMIN_PASSWORD'])
 
 
+def prepare_devstack_bundle(args, indent=''):
+    """Clones (or updates) and patches devstack locally into a git bundle.
+
+    The clone is a (kept) mirror that is only fetched into on later runs,
+    and bundles are kept (and reused) for as long as the branch and the
+    patches stay the same. Returns the path of the bundle.
+    """
+    git = local['git']
+    mirror = args.devstack_mirror
+    if os.path.isdir(mirror):
+        with utils.Spinner("%sFetching into devstack mirror"
+                           " %s" % (indent, mirror), args.verbose):
+            git('--git-dir', mirror, 'fetch', '--quiet', '--prune', 'origin')
+    else:
+        with utils.Spinner("%sCloning devstack mirror"
+                           " %s" % (indent, mirror), args.verbose):
+            git('clone', '--quiet', '--mirror', STACK_SOURCE, mirror)
+    hasher = hashlib.sha256()
+    hasher.update(git('--git-dir', mirror, 'rev-parse',
+                      "%s^{commit}" % args.branch).strip().encode("utf8"))
+    patch_paths = [os.path.join(args.patches, file_name)
+                   for file_name in sorted(os.listdir(args.patches))
+                   if file_name.endswith(".patch")]
+    for patch_path in patch_paths:
+        with open(patch_path, 'rb') as fh:
+            hasher.update(fh.read())
+    bundle_path = os.path.join(utils.safe_make_dir(args.scratch_dir),
+                               "devstack-%s.bundle" % hasher.hexdigest()[0:12])
+    if os.path.exists(bundle_path):
+        print("%sReusing devstack bundle %s" % (indent, bundle_path))
+        return bundle_path
+    work_dir = tempfile.mkdtemp()
+    try:
+        with utils.Spinner("%sPatching devstack (with %s patch file/s) into"
+                           " %s" % (indent, len(patch_paths), bundle_path),
+                           args.verbose):
+            git('clone', '--quiet', '--branch', args.branch, mirror, work_dir)
+            with local.cwd(work_dir):
+                git('checkout', '--quiet', '-B', DEVSTACK_BUNDLE_BRANCH)
+                if patch_paths:
+                    git('-c', 'user.name=builder',
+                        '-c', 'user.email=builder@localhost',
+                        'am', '--quiet', *patch_paths)
+                git('bundle', 'create', bundle_path + ".tmp",
+                    DEVSTACK_BUNDLE_BRANCH)
+            os.rename(bundle_path + ".tmp", bundle_path)
+    finally:
+        shutil.rmtree(work_dir)
+    return bundle_path
+
+
 def clone_devstack(args, helper, server, indent='', last_result=None):
     """Adjusts prior devstack and/or clones devstack + adjusts branch."""
+    if args.devstack_bundle:
+        clone_devstack_bundle(args, helper, server, indent=indent)
+        return
     machine = helper.machines[server.name]
-    old_path = machine.path("devstack")
-    if not old_path.exists():
-        with utils.Spinner("%sCloning devstack"
-                           " in %s" % (indent, server.hostname),
-                           args.verbose):
-            git = machine['git']
-            git("clone", STACK_SOURCE, "devstack")
-            git('checkout', args.branch, cwd="devstack")
-    else:
-        with utils.Spinner("%sResetting devstack"
-                           " in %s" % (indent, server.hostname),
-                           args.verbose):
-            git = machine['git']
-            git("reset", "--hard", "HEAD", cwd='devstack')
-            git('checkout', args.branch, cwd="devstack")
+    with utils.Spinner("%sCloning (or resetting) devstack"
+                       " in %s" % (indent, server.hostname),
+                       args.verbose):
+        script = scripts.Script()
+        script.add('clone',
+                   "if [ -e devstack ]; then"
+                   " (cd devstack && git reset --hard HEAD);"
+                   " else git clone %s devstack; fi"
+                   % six.moves.shlex_quote(STACK_SOURCE))
+        script.add('checkout', "cd devstack && git checkout %s"
+                   % six.moves.shlex_quote(args.branch))
+        script.run(machine)
+
+
+def clone_devstack_bundle(args, helper, server, indent=''):
+    """Clones (or resets) devstack from the shipped (patched) git bundle."""
+    bundle_path = "%s/devstack.bundle" % DEVSTACK_BUNDLE_DIR
+    devstack_path = "/home/%s/devstack" % DEF_USER
+    branch = DEVSTACK_BUNDLE_BRANCH
+    with utils.Spinner("%sCloning (or resetting) devstack (from a bundle)"
+                       " in %s" % (indent, server.hostname), args.verbose):
+        send_bundle(args, helper, server,
+                    args.artifacts['devstack'],
+                    DEVSTACK_BUNDLE_DIR,
+                    after="if [ -e %(dir)s ]; then"
+                          " cd %(dir)s && git fetch -q %(bundle)s %(branch)s"
+                          " && git checkout -q -f -B %(branch)s FETCH_HEAD;"
+                          " else git clone -q -b %(branch)s %(bundle)s"
+                          " %(dir)s; fi" % {'dir': devstack_path,
+                                            'bundle': bundle_path,
+                                            'branch': branch},
+                    indent=indent, artifact='devstack')
+
+
+def gather_ssh_keys(args, helper, servers=None, indent=''):
+    """Finds (or creates) each stack users ssh key (on every server)."""
+    keys_to_server = {}
+    # NOTE: every server needs every other servers key, so this
+    # always finds keys on all servers (not just the given ones).
+    for server in helper.iter_servers():
+        with utils.Spinner("%sFinding/generating ssh key(s) for"
+                           " %s" % (indent, server.name), args.verbose):
+            machine = helper.machines[server.name]
+            script = scripts.Script()
+            script.add('ssh_dir', "[ -d .ssh ] || { mkdir .ssh &&"
+                                  " chmod 700 .ssh; }")
+            # Forcefully regenerate them (unless both are already there).
+            script.add('ssh_keygen',
+                       "if [ ! -f .ssh/id_rsa ] ||"
+                       " [ ! -f .ssh/id_rsa.pub ]; then"
+                       " rm -f .ssh/id_rsa .ssh/id_rsa.pub &&"
+                       " ssh-keygen -q -t rsa -f /home/%s/.ssh/id_rsa"
+                       " -N ''; fi" % DEF_USER)
+            script.add('pub_key', "cat .ssh/id_rsa.pub")
+            results = script.run(machine)
+            keys_to_server[server.name] = results['pub_key'].output.strip()
+    return keys_to_server
 
 
 def interconnect_ssh(args, helper, server, indent='', last_result=None):
     """Creates & copies each stack users ssh key to each other server."""
     if last_result is None:
-        keys_to_server = {}
-        for server in helper.iter_servers():
-            with utils.Spinner("%sFinding/generating ssh key(s) for"
-                               " %s" % (indent, server.name), args.verbose):
-                machine = helper.machines[server.name]
-                ssh_dir = machine.path(".ssh")
-                if not ssh_dir.exists():
-                    ssh_dir.mkdir()
-                    ssh_dir.chmod(0o700)
-                # Clear off any old keys (unless already there).
-                found = 0
-                for base_key in ["id_rsa", "id_rsa.pub"]:
-                    key_path = machine.path("~/.ssh/%s" % base_key)
-                    if key_path.isfile():
-                        found += 1
-                if found < 2:
-                    # Ok forcefully regenerate them...
-                    for base_key in ["id_rsa", "id_rsa.pub"]:
-                        key_path = machine.path("~/.ssh/%s" % base_key)
-                        if key_path.isfile():
-                            key_path.delete()
-                    found = 0
-                if not found:
-                    key_gen = machine['ssh-keygen']
-                    key_gen("-t", "rsa", "-f",
-                            "/home/%s/.ssh/id_rsa" % DEF_USER, "-N", "")
-                server_pub_key_path = machine.path(".ssh/id_rsa.pub")
-                server_pub_key = server_pub_key_path.read()
-                keys_to_server[server.name] = server_pub_key.strip()
+        keys_to_server = gather_ssh_keys(args, helper, [server],
+                                         indent=indent)
     else:
         keys_to_server = last_result
     auth_key_contents = six.StringIO()
@@ -320,12 +529,12 @@ def interconnect_ssh(args, helper, server, indent='', last_result=None):
     machine = helper.machines[server.name]
     # Do this in 2 steps to avoid overwriting if we can't
     # upload it (for whatever reason).
-    auth_keys_path = machine.path(".ssh/authorized_keys")
-    new_auth_keys_path = machine.path(".ssh/authorized_keys.new")
-    new_auth_keys_path.touch()
-    new_auth_keys_path.write(auth_key_contents.getvalue())
-    new_auth_keys_path.chmod(0o600)
-    new_auth_keys_path.move(auth_keys_path)
+    script = scripts.Script()
+    script.write_file('new_auth_keys', ".ssh/authorized_keys.new",
+                      auth_key_contents.getvalue(), mode=0o600)
+    script.add('auth_keys',
+               "mv -f .ssh/authorized_keys.new .ssh/authorized_keys")
+    script.run(machine)
     return keys_to_server
 
 
@@ -335,16 +544,7 @@ def install_some_packages(args, helper, server, indent='', last_result=None):
     sudo = machine['sudo']
     yum = sudo[machine['yum']]
     yum_install_cmd = utils.RemoteCommand(
-        yum, "-y", "install",
-        # We need to get the mariadb package (the client) installed
-        # so that future runs of stack.sh which will not install the
-        # mariadb-server will be able to interact with the database,
-        #
-        # Otherwise it ends badly at stack.sh run-time... (maybe
-        # something we can fix in devstack?)
-        'mariadb',
-        # This is wanted for our overlay (eventually),
-        'openvswitch',
+        yum, "-y", "install", *SOME_PACKAGES,
         scratch_dir=args.scratch_dir,
         server=server)
     utils.run_and_record([yum_install_cmd],
@@ -353,45 +553,224 @@ def install_some_packages(args, helper, server, indent='', last_result=None):
     service('openvswitch', 'restart')
 
 
+class Artifacts(object):
+    """Bundles (of local files) sent to each server, made once when needed.
+
+    They are made on first use (and not up front) since some of them need
+    to know about servers (like their ips) that may not be known yet.
+    """
+
+    def __init__(self, args, helper):
+        self._args = args
+        self._helper = helper
+        self._bundles = None
+        self._lock = threading.Lock()
+
+    def _get_bundles(self):
+        with self._lock:
+            if self._bundles is None:
+                self._bundles = make_artifacts(self._args, self._helper)
+            return self._bundles
+
+    def __getitem__(self, name):
+        return self._get_bundles()[name]
+
+    def items(self):
+        return list(self._get_bundles().items())
+
+
+def make_artifacts(args, helper):
+    """Makes the bundles (of local files) that get sent to each server."""
+    bundles = collections.OrderedDict()
+    for name, local_dir, suffix in [('repos', args.repos, ".repo"),
+                                    ('patches', args.patches, ".patch"),
+                                    ('extras', args.extras, ".sh")]:
+        bundle = transfer.Bundle()
+        bundle.add_dir(local_dir, suffix=suffix)
+        bundles[name] = bundle
+    if args.package_cache:
+        bundles['repos'].add("%s.repo" % PACKAGES_REPO,
+                             contents=render_packages_repo(helper))
+    bundle = transfer.Bundle()
+    # Only made (and so only sent) when some server still has to clone.
+    if args.devstack_bundle_path:
+        bundle.add("devstack.bundle", local_path=args.devstack_bundle_path)
+    bundles['devstack'] = bundle
+    return bundles
+
+
+def broadcast_artifacts(args, helper, indent=''):
+    """Sends the artifacts once (servers relay them to each other)."""
+    bundles = dict((name, bundle)
+                   for name, bundle in args.artifacts.items()
+                   if len(bundle))
+    servers = [server for server in helper.iter_servers()
+               if server.builder_state < st.UPLOAD_EXTRAS_END]
+    if not bundles or not servers:
+        return
+    print("%sBroadcasting %s artifact bundle/s to %s server/s (with a"
+          " fan-out of %s)." % (indent, len(bundles), len(servers),
+                                args.broadcast_fanout))
+    rounds = transfer.broadcast(helper.machines, servers[0], servers,
+                                bundles, ARTIFACTS_DIR,
+                                fanout=args.broadcast_fanout,
+                                indent=indent + "  ", verbose=args.verbose)
+    print("%sBroadcasting finished after %s relay round/s." % (indent,
+                                                               rounds))
+
+
+def send_bundle(args, helper, server, bundle, target_dir,
+                sudo=False, after=None, indent='', artifact=None):
+    """Sends the files (of a bundle) that differ from what was sent before.
+
+    What was last sent (the sha256 of each file, by remote path) is kept
+    in the server's record, so files that were already sent (unchanged)
+    are skipped; nothing is ran if nothing changed and there is nothing
+    to run afterwards. Artifacts (when broadcasting them) are instead
+    unpacked from where they were staged on the server.
+    """
+    digests = bundle.digests(target_dir)
+    uploads = server.uploads or {}
+    same = [path for path, digest in six.iteritems(digests)
+            if uploads.get(path) == digest]
+    if same and args.verify_uploads:
+        remote = transfer.remote_digests(helper.machines[server.name], same)
+        same = [path for path in same if remote.get(path) == digests[path]]
+    if same:
+        bundle = bundle.without(target_dir, same)
+        if args.verbose:
+            print("%sSkipping %s unchanged file/s already on %s" % (
+                indent, len(same), server.name))
+    if artifact is not None and args.broadcast_fanout:
+        if len(bundle) or after:
+            transfer.unpack(helper.machines[server.name],
+                            "%s/%s.tgz" % (ARTIFACTS_DIR, artifact),
+                            target_dir, sudo=sudo, after=after)
+    elif len(bundle) or after:
+        bundle.send(helper.machines[server.name], target_dir,
+                    sudo=sudo, after=after)
+    with helper.tracker.lock:
+        if server.uploads is None:
+            server.uploads = {}
+        server.uploads.update(digests)
+    helper.save_server(server)
+
+
+def find_packages_server(helper):
+    """Returns the server the rpms are (or will be) served from."""
+    return list(helper.iter_server_by_kind(Roles.DB))[0]
+
+
+def render_packages_repo(helper):
+    """Renders the repos.d file of the (served) rpms."""
+    # Picked over the same packages from other repos (their cost is
+    # 1000 by default) and skipped (not failing yum) if unreachable.
+    return "\n".join([
+        "[%s]" % PACKAGES_REPO,
+        "name=Builder rpms (served from %s)" % (
+            find_packages_server(helper).name),
+        "baseurl=http://%s:%s/" % (find_packages_server(helper).ip,
+                                   PACKAGES_PORT),
+        "enabled=1",
+        "gpgcheck=0",
+        "cost=1",
+        "skip_if_unavailable=1",
+        "metadata_expire=0",
+        "",
+    ])
+
+
+def prefetch_packages(args, helper, indent=''):
+    """Downloads the rpms servers will install (once) and serves them.
+
+    Which rpms (and their dependencies) get downloaded comes from the
+    packages installed ahead of stack.sh and the rpm lists in devstack
+    (for the branch used); they are downloaded (into a directory kept
+    between runs) on one server, which serves them as a yum repo (the
+    repos.d file for it is uploaded along with the others).
+    """
+    packages_server = find_packages_server(helper)
+    machine = helper.machines[packages_server.name]
+    # This server resolves (and downloads) with the same repos the
+    # others use (not including the one it will serve).
+    bundle = transfer.Bundle()
+    bundle.add_dir(args.repos, suffix=".repo")
+    send_bundle(args, helper, packages_server, bundle, "/etc/yum.repos.d",
+                sudo=True, after="yum clean all", indent=indent)
+    src_dir = "%s/devstack" % PACKAGES_DIR
+    with utils.Spinner("%sFinding the rpms stack.sh installs on"
+                       " %s" % (indent, packages_server.hostname),
+                       args.verbose):
+        script = scripts.Script()
+        script.add('src_dir', "rm -rf %(dir)s && mkdir -p %(dir)s"
+                   % {'dir': src_dir})
+        script.add('clone', "git clone -q --depth 1 -b %s %s %s"
+                   % (six.moves.shlex_quote(args.branch),
+                      six.moves.shlex_quote(STACK_SOURCE), src_dir))
+        script.add('rpms', "sed -e 's/#.*//' %s/files/rpms/*"
+                           " | awk 'NF { print $1 }' | sort -u" % src_dir)
+        results = script.run(machine)
+    packages = set(SOME_PACKAGES)
+    packages.update(results['rpms'].output.split())
+    with utils.Spinner("%sDownloading (or reusing) %s rpms (and their"
+                       " dependencies) on %s" % (indent, len(packages),
+                                                 packages_server.hostname),
+                       args.verbose):
+        script = scripts.Script()
+        script.add('tools', "sudo yum -y -q install yum-utils createrepo")
+        # Packages (in devstack lists) that do not exist (for this
+        # distro) are skipped (they would fail the same in stack.sh).
+        script.add('download',
+                   "yumdownloader -q --resolve --destdir %s %s || true"
+                   % (PACKAGES_DIR, " ".join(
+                       six.moves.shlex_quote(package)
+                       for package in sorted(packages))))
+        script.add('createrepo', "createrepo -q --update %s" % PACKAGES_DIR)
+        # Left running (serving the repo) after this exits.
+        script.add('serve',
+                   "pgrep -f 'SimpleHTTPServer %(port)s' > /dev/null ||"
+                   " (cd %(dir)s && setsid nohup python -m SimpleHTTPServer"
+                   " %(port)s < /dev/null > /dev/null 2>&1 &)"
+                   % {'dir': PACKAGES_DIR, 'port': PACKAGES_PORT})
+        script.run(machine)
+
+
 def upload_repos(args, helper, server, indent='', last_result=None):
     """Uploads all repos.d files into corresponding repos.d directory."""
     file_names = [file_name
                   for file_name in os.listdir(args.repos)
                   if file_name.endswith(".repo")]
+    if args.package_cache:
+        file_names.append("%s.repo" % PACKAGES_REPO)
     if file_names:
-        machine = helper.machines[server.name]
         with utils.Spinner("%sUploading %s repos.d file/s to"
                            " %s" % (indent, len(file_names),
                                     server.hostname), args.verbose):
-            for file_name in file_names:
-                target_path = "/etc/yum.repos.d/%s" % (file_name)
-                tmp_path = "/tmp/%s" % (file_name)
-                local_path = os.path.join(args.repos, file_name)
-                machine.upload(local_path, tmp_path)
-                sudo = machine['sudo']
-                mv = sudo[machine['mv']]
-                mv(tmp_path, target_path)
-                yum = sudo[machine['yum']]
-                yum('clean', 'all')
+            send_bundle(args, helper, server,
+                        args.artifacts['repos'],
+                        "/etc/yum.repos.d", sudo=True, after="yum clean all",
+                        indent=indent, artifact='repos')
 
 
 def patch_devstack(args, helper, server, indent='', last_result=None):
     """Applies local devstack patches to cloned devstack."""
+    if args.devstack_bundle:
+        # Already applied (when the shipped bundle was made).
+        return
     file_names = [file_name
                   for file_name in os.listdir(args.patches)
                   if file_name.endswith(".patch")]
     if file_names:
-        machine = helper.machines[server.name]
         with utils.Spinner("%sUploading (and applying) %s patch file/s to"
                            " %s" % (indent, len(file_names),
                                     server.hostname), args.verbose):
-            for file_name in file_names:
-                target_path = "/home/%s/devstack/%s" % (DEF_USER,
-                                                        file_name)
-                local_path = os.path.join(args.patches, file_name)
-                machine.upload(local_path, target_path)
-                git = machine['git']
-                git("am", file_name, cwd='devstack')
+            send_bundle(args, helper, server,
+                        args.artifacts['patches'],
+                        "/home/%s/devstack" % DEF_USER,
+                        after="git am %s" % " ".join(
+                            six.moves.shlex_quote(file_name)
+                            for file_name in sorted(file_names)),
+                        indent=indent, artifact='patches')
 
 
 def upload_extras(args, helper, server, indent='', last_result=None):
@@ -400,19 +779,59 @@ def upload_extras(args, helper, server, indent='', last_result=None):
                   for file_name in os.listdir(args.extras)
                   if file_name.endswith(".sh")]
     if file_names:
-        machine = helper.machines[server.name]
         with utils.Spinner("%sUploading %s extras.d file/s to"
                            " %s" % (indent, len(file_names),
                                     server.hostname), args.verbose):
-            for file_name in file_names:
-                target_path = "/home/%s/devstack/extras.d/%s" % (DEF_USER,
-                                                                 file_name)
-                local_path = os.path.join(args.extras, file_name)
-                machine.upload(local_path, target_path)
+            send_bundle(args, helper, server,
+                        args.artifacts['extras'],
+                        "/home/%s/devstack/extras.d" % DEF_USER,
+                        indent=indent, artifact='extras')
 
 
-def create_local_files(args, helper, server, indent='', last_result=None):
-    """Creates and uploads local.conf files for devstack."""
+def local_conf_repos(contents):
+    """Returns the git repos stack.sh clones (given a local.conf)."""
+    services = set()
+    for line in contents.splitlines():
+        line = line.strip()
+        if line.startswith("ENABLED_SERVICES+="):
+            line = line[len("ENABLED_SERVICES+="):]
+        elif line.startswith("ENABLED_SERVICES="):
+            line = line[len("ENABLED_SERVICES="):]
+            services.clear()
+        else:
+            continue
+        services.update(service.strip() for service in line.split(",")
+                        if service.strip())
+    repos = []
+    for name, (_repo_var, repo_services) in six.iteritems(GIT_REPOS):
+        if not repo_services:
+            repos.append(name)
+            continue
+        for service in services:
+            if any(service == match or (match.endswith("-") and
+                                        service.startswith(match))
+                   for match in repo_services):
+                repos.append(name)
+                break
+    return repos
+
+
+def find_mirror_server(helper):
+    """Returns the server the git mirror is (or will be) on."""
+    return list(helper.iter_server_by_kind(Roles.DB))[0]
+
+
+def mirror_url(helper, server, repo):
+    """Returns where a server should clone a (mirrored) git repo from."""
+    mirror_server = find_mirror_server(helper)
+    path = "%s/openstack/%s.git" % (GIT_MIRROR_DIR, repo)
+    if server is mirror_server:
+        return path
+    return "ssh://%s@%s%s" % (DEF_USER, mirror_server.ip, path)
+
+
+def render_local_conf(args, helper, server, mirrored=True):
+    """Renders the local.conf (for devstack) of a server."""
     # This needs to be done so that servers that will not have rabbit
     # or the database on them (but need to access it will still have
     # access to them, or know how to get to them).
@@ -422,43 +841,217 @@ def create_local_files(args, helper, server, indent='', last_result=None):
     params.update({
         'DATABASE_HOST': dbs[0].hostname,
         'RABBIT_HOST': rbs[0].hostname,
+        'GIT_REPO_URLS': [],
     })
-    target_path = "/home/%s/devstack/local.conf" % DEF_USER
-    machine = helper.machines[server.name]
+    tpl = args.template_fetcher("local.%s.tpl" % server.kind.name.lower())
+    contents = tpl.render(**params)
+    if args.git_mirror and mirrored:
+        # Which repos get cloned depends on the (enabled) services, so
+        # those have to be known before pointing them at the mirror.
+        params['GIT_REPO_URLS'] = [
+            (GIT_REPOS[repo][0], mirror_url(helper, server, repo))
+            for repo in local_conf_repos(contents)]
+        contents = tpl.render(**params)
+    if not contents.endswith("\n"):
+        contents += "\n"
+    return contents
+
+
+def create_local_files(args, helper, server, indent='', last_result=None):
+    """Creates and uploads local.conf files for devstack."""
     with utils.Spinner("%sUploading local.conf to"
                        " %s" % (indent, server.hostname), args.verbose):
         local_path = os.path.join(args.scratch_dir,
                                   "local.%s.conf" % server.hostname)
-        tpl = args.template_fetcher(
-            "local.%s.tpl" % server.kind.name.lower())
-        tpl_contents = tpl.render(**params)
-        if not tpl_contents.endswith("\n"):
-            tpl_contents += "\n"
         with utils.safe_open(local_path, 'wb') as o_fh:
-            o_fh.write(tpl_contents)
-        machine.upload(local_path, target_path)
+            o_fh.write(render_local_conf(args, helper, server))
+        bundle = transfer.Bundle()
+        bundle.add("local.conf", local_path=local_path)
+        send_bundle(args, helper, server, bundle,
+                    "/home/%s/devstack" % DEF_USER, indent=indent)
+
+
+def mirror_git_repos(args, helper, indent=''):
+    """Mirrors (or updates mirrors of) the git repos stack.sh clones."""
+    mirror_server = find_mirror_server(helper)
+    repos = set()
+    for server in helper.iter_servers():
+        if server.builder_state < st.SEED_REPOS_END:
+            repos.update(local_conf_repos(
+                render_local_conf(args, helper, server, mirrored=False)))
+    if not repos:
+        return
+    with utils.Spinner("%sMirroring %s git repos onto"
+                       " %s" % (indent, len(repos), mirror_server.hostname),
+                       args.verbose):
+        script = scripts.Script()
+        script.add('mirror_dir', "mkdir -p %s/openstack" % GIT_MIRROR_DIR)
+        for repo in sorted(repos):
+            path = "%s/openstack/%s.git" % (GIT_MIRROR_DIR, repo)
+            script.add('mirror_%s' % repo,
+                       "if [ -d %(path)s ]; then"
+                       " git --git-dir %(path)s fetch -q --prune;"
+                       " else git clone -q --mirror %(url)s %(path)s; fi"
+                       % {'path': path,
+                          'url': "%s/openstack/%s.git" % (GIT_UPSTREAM,
+                                                          repo)})
+        script.run(helper.machines[mirror_server.name])
+
+
+def seed_opt_stack(args, helper, server, indent='', last_result=None):
+    """Clones the git repos stack.sh needs (from the mirror) ahead of it."""
+    repos = local_conf_repos(render_local_conf(args, helper, server,
+                                               mirrored=False))
+    machine = helper.machines[server.name]
+    with utils.Spinner("%sSeeding /opt/stack with %s git repos on"
+                       " %s" % (indent, len(repos), server.hostname),
+                       args.verbose):
+        script = scripts.Script()
+        script.add('opt_stack', "sudo mkdir -p /opt/stack &&"
+                                " sudo chown %s /opt/stack" % DEF_USER)
+        for repo in repos:
+            # Repos already there (from prior stack.sh runs) are left to
+            # stack.sh (to update, or not) as is.
+            script.add('seed_%s' % repo,
+                       "[ -d /opt/stack/%(repo)s ] ||"
+                       " git clone -q -b %(branch)s %(url)s"
+                       " /opt/stack/%(repo)s"
+                       % {'repo': repo,
+                          'branch': six.moves.shlex_quote(args.branch),
+                          'url': mirror_url(helper, server, repo)})
+        script.run(machine)
+
+
+def build_wheelhouse(args, helper, indent=''):
+    """Builds wheels (once) of the requirements of the repos stack.sh clones.
+
+    Wheels are built (on the git mirror server) into a directory named
+    by the hash of the branch and the requirements (and constraints) they
+    were built from, so later runs reuse them until those change. Returns
+    where they are.
+    """
+    build_server = find_mirror_server(helper)
+    machine = helper.machines[build_server.name]
+    repos = set(['requirements'])
+    for server in helper.iter_servers():
+        if server.builder_state < st.WHEELHOUSE_END:
+            repos.update(local_conf_repos(
+                render_local_conf(args, helper, server, mirrored=False)))
+    src_dir = "%s/src" % WHEELS_DIR
+    with utils.Spinner("%sGetting sources of %s repos (to build wheels"
+                       " from) on %s" % (indent, len(repos),
+                                         build_server.hostname),
+                       args.verbose):
+        script = scripts.Script()
+        script.add('src_dir', "rm -rf %(dir)s && mkdir -p %(dir)s"
+                   % {'dir': src_dir})
+        for repo in sorted(repos):
+            script.add('clone_%s' % repo,
+                       "git clone -q --depth 1 -b %s %s/openstack/%s.git"
+                       " %s/%s" % (six.moves.shlex_quote(args.branch),
+                                   GIT_UPSTREAM, repo, src_dir, repo))
+        script.add('requirements',
+                   "cd %s && cat requirements/upper-constraints.txt"
+                   " */requirements.txt 2>/dev/null" % src_dir, check=False)
+        results = script.run(machine)
+    hasher = hashlib.sha256()
+    hasher.update(args.branch.encode("utf8"))
+    hasher.update(results['requirements'].output.encode("utf8"))
+    wheels_dir = "%s/%s" % (WHEELS_DIR, hasher.hexdigest()[0:12])
+    with utils.Spinner("%sBuilding (or reusing) wheels in %s on"
+                       " %s" % (indent, wheels_dir, build_server.hostname),
+                       args.verbose):
+        # A repo whose requirements fail to build (or fail to all build)
+        # is fine; pip will still find (and build) whatever is missing.
+        build_cmd = ("pip wheel -q -w %(tmp)s"
+                     " $([ -f %(src)s/requirements/upper-constraints.txt ] &&"
+                     " echo -c %(src)s/requirements/upper-constraints.txt)"
+                     " -r %(src)s/$repo/requirements.txt || true"
+                     % {'tmp': wheels_dir + ".tmp", 'src': src_dir})
+        script = scripts.Script()
+        script.add('build',
+                   "[ -d %(dir)s ] || {"
+                   " (cd /home/%(user)s/devstack &&"
+                   " ./tools/install_prereqs.sh && ./tools/install_pip.sh) &&"
+                   " sudo -H pip install -q wheel &&"
+                   " rm -rf %(tmp)s && mkdir -p %(tmp)s &&"
+                   " for repo in %(repos)s; do %(build)s; done &&"
+                   " mv %(tmp)s %(dir)s; }"
+                   % {'dir': wheels_dir, 'tmp': wheels_dir + ".tmp",
+                      'user': DEF_USER,
+                      'repos': " ".join(sorted(repos - set(['requirements']))),
+                      'build': build_cmd})
+        script.run(machine)
+    return wheels_dir
+
+
+def install_wheelhouse(args, helper, server, indent='', last_result=None):
+    """Copies the (built) wheels to a server and points pip at them."""
+    wheels_dir = last_result
+    build_server = find_mirror_server(helper)
+    machine = helper.machines[server.name]
+    with utils.Spinner("%sInstalling wheelhouse on"
+                       " %s" % (indent, server.hostname), args.verbose):
+        script = scripts.Script()
+        if server is build_server:
+            find_links = wheels_dir
+        else:
+            find_links = WHEELHOUSE_DIR
+            # The wheels are kept (and only copied again when they change).
+            script.add('copy',
+                       "[ \"$(cat %(house)s/.built-in 2>/dev/null)\" ="
+                       " %(dir)s ] || { rm -rf %(house)s &&"
+                       " mkdir -p %(house)s &&"
+                       " ssh -o BatchMode=yes %(user)s@%(ip)s"
+                       " 'tar -cf - -C %(dir)s .' | tar -xf - -C %(house)s"
+                       " && echo %(dir)s > %(house)s/.built-in; }"
+                       % {'house': WHEELHOUSE_DIR, 'dir': wheels_dir,
+                          'user': DEF_USER, 'ip': build_server.ip})
+        # The index has to stay reachable (so no-index is not set), since
+        # the wheels only cover requirements that built; anything else
+        # (requirements that failed to build, pip and setuptools
+        # themselves, build-only dependencies) still comes from it. As
+        # stack.sh installs with the same upper-constraints the wheels
+        # were built with, the index never has a different version (of
+        # what was built) for pip to prefer over the wheels.
+        script.write_file('pip_conf', "/tmp/builder.pip.conf",
+                          "[global]\n"
+                          "# Wheels built for this cluster (the index is"
+                          " still used for anything they miss).\n"
+                          "find-links = %s\n" % find_links)
+        script.add('install_pip_conf',
+                   "sudo mv -f /tmp/builder.pip.conf /etc/pip.conf &&"
+                   " sudo chmod 644 /etc/pip.conf")
+        script.run(machine)
 
 
 def bind_hostname(helper, server, last_result=None, indent=''):
     """Attaches fully qualified hostname to server object."""
-    if 'hostname' not in server:
+    if not server.hostname:
         machine = helper.machines[server.name]
         hostname = machine['hostname']("-f")
         hostname = hostname.strip()
-        server.hostname = hostname
-        helper.save_topo()
+        with helper.tracker.lock:
+            server.hostname = hostname
+        helper.save_server(server)
 
 
-def fill_topo(args, cloud, tracker,
-              topo, az_selector, flavors,
-              image):
+def render_userdata(args, cloud):
     ud_params = {
         'USER': DEF_USER,
         'USER_PW': DEF_PW,
         'CREATOR': cloud.auth['username'],
     }
     ud_tpl = args.template_fetcher("ud.tpl")
-    ud = ud_tpl.render(**ud_params)
+    return ud_tpl.render(**ud_params)
+
+
+def fill_topo(args, cloud, tracker,
+              topo, az_selector, flavors,
+              image):
+    # This is just for visuals (servers only reference these by id)...
+    flavor_names = dict((flv.id, flv.name) for flv in flavors.values())
+    image_names = {image.id: image.name}
     pretty_topo = {}
     filled_am = 0
     for plane, servers in [('compute', topo['compute']),
@@ -466,17 +1059,18 @@ def fill_topo(args, cloud, tracker,
         pretty_topo[plane] = {}
         for server in servers:
             if not server.filled:
-                server.flavor = flavors[server.kind]
-                server.image = image
-                server.availability_zone = az_selector()
-                server.userdata = ud
-                server.filled = True
+                with tracker.lock:
+                    server.flavor_id = flavors[server.kind].id
+                    server.image_id = image.id
+                    server.availability_zone = az_selector()
+                    server.filled = True
                 filled_am += 1
             # This is just for visuals...
             pretty_topo[plane][server.name] = {
                 'name': server.name,
-                'flavor': server.flavor.name,
-                'image': server.image.name,
+                'flavor': flavor_names.get(server.flavor_id,
+                                           server.flavor_id),
+                'image': image_names.get(server.image_id, server.image_id),
                 'availability_zone': server.availability_zone,
                 'kind': server.kind.name,
             }
@@ -490,28 +1084,50 @@ def fill_topo(args, cloud, tracker,
     return topo
 
 
-def wait_servers(args, cloud, tracker, servers):
-    # Wait for them to actually become active...
-    print("Waiting for instances to enter ACTIVE state.")
-    for server in servers:
-        with utils.Spinner("  Waiting for %s" % server.name, args.verbose):
-            if server.status != 'ACTIVE':
-                a_server = cloud.wait_for_server(server, auto_ip=False)
-                merge_servers(server, a_server)
-        server_ip = utils.get_server_ip(server)
-        if not server_ip:
-            raise RuntimeError("Instance %s spawned but no ip"
-                               " was found associated" % server.name)
-        server.ip = server_ip
+def wait_server(args, cloud, recorder, server, indent=''):
+    """Waits for a server to enter the ACTIVE state (and have an ip)."""
+    if server.status != 'ACTIVE' or not server.ip:
+        print("%sWaiting for %s to enter ACTIVE state."
+              % (indent, server.name))
+        with recorder.time_server(server, 'wait_active'):
+            a_server = cloud.wait_for_server(cloud.get_server(server.id),
+                                             auto_ip=False)
+            with recorder.tracker.lock:
+                server.merge(a_server)
+    if not server.ip:
+        raise RuntimeError("Instance %s spawned but no ip"
+                           " was found associated" % server.name)
+
+
+def connect_server(args, cloud, recorder, server, indent=''):
+    """Waits for a server to be ACTIVE and then connects to it (over ssh)."""
+    wait_server(args, cloud, recorder, server, indent=indent)
+    with recorder.time_server(server, 'ssh_connect'):
+        machine = args.connector(server.ip, indent=indent,
+                                 user=DEF_USER, password=DEF_PW,
+                                 server_name=server.name,
+                                 verbose=args.verbose)
+    print("%sServer %s is ACTIVE and connected to." % (indent, server.name))
+    return machine
+
+
+def boot_and_connect(helper, server):
+    """Connects to a server (waiting for it to boot) ahead of its stages."""
+    helper.machines[server.name]
 
 
 def create_topo(args, cloud, tracker, curr_servers):
+    # Big enough that (even with many servers) a random pick is rarely
+    # already taken, while keeping names short for small topologies.
+    rand_max = max(99, 4 * (len(curr_servers) + args.hypervisors +
+                            len(Roles)))
+
     def try_pick_name(name_tpl, new_names, max_attempts=100):
         attempts = 0
         while attempts < max_attempts:
             name = name_tpl % {
                 'user': cloud.auth['username'],
-                'rand': random.randrange(1, 99),
+                'rand': random.randrange(1, rand_max),
             }
             if name not in curr_servers and name not in new_names:
                 return name
@@ -526,27 +1142,27 @@ def create_topo(args, cloud, tracker, curr_servers):
     if not topo:
         topo = copy.deepcopy(DEF_TOPO)
     new_names = set()
-    hvs = topo['compute']
-    while len(hvs) < args.hypervisors:
-        name = try_pick_name(topo['templates'][Roles.HV], new_names)
-        new_names.add(name)
-        hvs.append(munch.Munch(name=name, filled=False,
-                               kind=Roles.HV, builder_state=st.NO_STATE))
-    topo['compute'] = hvs[0:args.hypervisors]
-    for r in Roles:
-        if r != Roles.HV:
-            if r not in topo['control']:
-                name = try_pick_name(topo['templates'][r], new_names)
-                new_names.add(name)
-                topo['control'][r] = munch.Munch(
-                    name=name, filled=False,
-                    kind=r, builder_state=st.NO_STATE)
-    tracker["topo"] = topo
+    with tracker.lock:
+        # Older topologies stored full server munches, shrink them...
+        sv.compact_topo(topo)
+        hvs = topo['compute']
+        while len(hvs) < args.hypervisors:
+            name = try_pick_name(topo['templates'][Roles.HV], new_names)
+            new_names.add(name)
+            hvs.append(sv.Server(name, Roles.HV))
+        topo['compute'] = hvs[0:args.hypervisors]
+        for r in Roles:
+            if r != Roles.HV:
+                if r not in topo['control']:
+                    name = try_pick_name(topo['templates'][r], new_names)
+                    new_names.add(name)
+                    topo['control'][r] = sv.Server(name, r)
+        tracker["topo"] = topo
     tracker.sync()
     return topo
 
 
-def bake_servers(args, cloud, tracker, topo, curr_servers):
+def bake_servers(args, cloud, tracker, recorder, topo, curr_servers):
     missing_servers = []
     existing_servers = []
     for master_server in itertools.chain(topo['compute'],
@@ -556,9 +1172,9 @@ def bake_servers(args, cloud, tracker, topo, curr_servers):
         except KeyError:
             missing_servers.append(master_server)
         else:
-            merge_servers(master_server, server)
+            with tracker.lock:
+                master_server.merge(server)
             existing_servers.append(master_server)
-            master_server.ip = None
     if existing_servers:
         print("  Found:")
         for server in existing_servers:
@@ -580,26 +1196,30 @@ def bake_servers(args, cloud, tracker, topo, curr_servers):
             }
             meta = meta_tpl.render(**meta_params)
             meta = json.loads(meta)
+        ud = render_userdata(args, cloud)
         maybe_servers = tracker.get("maybe_servers", set())
         with utils.Spinner("  Spawning", args.verbose):
             for master_server in missing_servers:
                 # Save this so that if we kill the program
                 # before we save that we don't lose booted instances...
-                maybe_servers.add(master_server.name)
-                tracker['maybe_servers'] = maybe_servers
-                tracker.sync()
-                server = cloud.create_server(
-                    master_server.name, master_server.image,
-                    master_server.flavor, auto_ip=False,
-                    key_name=args.key_name,
-                    availability_zone=master_server.availability_zone,
-                    meta=meta, userdata=master_server.userdata,
-                    wait=False)
-                merge_servers(master_server, server)
-                # This is new so clear out whatever existing state there
-                # may have been from the prior servers....
-                master_server.builder_state = st.NO_STATE
-                master_server.ip = None
+                with tracker.lock:
+                    maybe_servers.add(master_server.name)
+                    tracker['maybe_servers'] = maybe_servers
+                tracker.flush()
+                with recorder.time_server(master_server, 'create_server'):
+                    server = cloud.create_server(
+                        master_server.name, master_server.image_id,
+                        master_server.flavor_id, auto_ip=False,
+                        key_name=args.key_name,
+                        availability_zone=master_server.availability_zone,
+                        meta=meta, userdata=ud, wait=False)
+                with tracker.lock:
+                    master_server.merge(server)
+                    # This is new so clear out whatever existing state there
+                    # may have been from the prior servers....
+                    master_server.builder_state = st.NO_STATE
+                    master_server.hostname = None
+                    master_server.uploads = {}
     else:
         print("  Spawning none.")
     tracker["topo"] = topo
@@ -608,8 +1228,13 @@ def bake_servers(args, cloud, tracker, topo, curr_servers):
     return existing_servers, new_servers
 
 
-def transform(args, helper):
-    """Turn (mostly) raw servers into useful things."""
+def transform(args, helper, prepare=None):
+    """Turn (mostly) raw servers into useful things.
+
+    If given, each server is prepared (with the prepare function) right
+    before its first stage (so servers that are ready early do not wait
+    on the others).
+    """
 
     def on_done_show_hostnames(helper, indent=''):
         for server in helper.iter_servers():
@@ -620,52 +1245,128 @@ def transform(args, helper):
               " file/s, please wait..." % (indent, helper.server_count))
         for server in helper.iter_servers():
             machine = helper.machines[server.name]
-            key_scan = machine['ssh-keyscan']
-            contents = six.StringIO()
-            for other_server in helper.iter_servers():
-                if other_server is not server:
-                    stdout = key_scan("-t", "ssh-rsa", other_server.ip)
-                    contents.write(stdout.strip())
-                    contents.write("\n")
-            known_hosts_path = machine.path(".ssh/known_hosts")
-            known_hosts_path.touch()
-            new_known_hosts_path = machine.path(".ssh/known_hosts.new")
-            new_known_hosts_path.touch()
-            new_known_hosts_path.write(contents.getvalue())
-            new_known_hosts_path.move(known_hosts_path)
-
-    # Mini-state/transition diagram + state identifiers (for resuming).
-    states = [
-        (st.BIND_START, st.BIND_END, bind_hostname, on_done_show_hostnames),
-        (st.INTER_SSH_START, st.INTER_SSH_END,
-         functools.partial(interconnect_ssh, args),
-         on_done_adjust_known_hosts),
-        (st.GIT_SETUP_START, st.GIT_SETUP_END,
-         functools.partial(setup_git, args), None),
-        (st.UPLOAD_REPO_START, st.UPLOAD_REPO_END,
-         functools.partial(upload_repos, args), None),
-        (st.INSTALL_PKG_START, st.INSTALL_PKG_END,
-         functools.partial(install_some_packages, args), None),
-        (st.CLONE_STACK_START, st.CLONE_STACK_END,
-         functools.partial(clone_devstack, args), None),
-        (st.PATCH_STACK_START, st.PATCH_STACK_END,
-         functools.partial(patch_devstack, args), None),
-        (st.UPLOAD_EXTRAS_START, st.UPLOAD_EXTRAS_END,
-         functools.partial(upload_extras, args), None),
-        (st.CREATE_LOCAL_START, st.CREATE_LOCAL_END,
-         functools.partial(create_local_files, args), None),
+            other_ips = [six.moves.shlex_quote(other_server.ip)
+                         for other_server in helper.iter_servers()
+                         if other_server is not server]
+            script = scripts.Script()
+            if other_ips:
+                script.add('key_scan',
+                           "ssh-keyscan -t ssh-rsa %s >"
+                           " .ssh/known_hosts.new" % " ".join(other_ips))
+            else:
+                script.add('key_scan', ": > .ssh/known_hosts.new")
+            script.add('known_hosts',
+                       "mv -f .ssh/known_hosts.new .ssh/known_hosts")
+            script.run(machine)
+
+    # Devstack is then cloned (and patched) here once (if anything is
+    # going to clone it) and shipped to all servers.
+    if args.devstack_bundle and any(
+            server.builder_state < st.CLONE_STACK_END
+            for server in helper.iter_servers()):
+        print("Preparing (patched) devstack bundle.")
+        args.devstack_bundle_path = prepare_devstack_bundle(args,
+                                                            indent="  ")
+    else:
+        args.devstack_bundle_path = None
+    args.artifacts = Artifacts(args, helper)
+
+    # When broadcasting, artifacts are relayed (over the stack users
+    # ssh) between servers, so that has to be setup on all of them first.
+    if args.broadcast_fanout:
+        artifact_steps = ['broadcast_artifacts']
+    else:
+        artifact_steps = []
+
+    # Repos (and packages) are only installed from the served rpms once
+    # those are there.
+    repo_steps = list(artifact_steps)
+    if args.package_cache:
+        repo_steps.append('prefetch_packages')
+
+    # Mini-state/transition diagram + state identifiers (for resuming),
+    # each server goes through these on its own (as fast as it can) except
+    # where a stage requires a cluster step (that needs all servers).
+    stages = [
+        pipeline.Stage('bind_hostname', st.BIND_START, st.BIND_END,
+                       bind_hostname),
+        pipeline.Stage('interconnect_ssh',
+                       st.INTER_SSH_START, st.INTER_SSH_END,
+                       functools.partial(interconnect_ssh, args),
+                       requires=['gather_ssh_keys'],
+                       last_result_from='gather_ssh_keys'),
+        pipeline.Stage('setup_git', st.GIT_SETUP_START, st.GIT_SETUP_END,
+                       functools.partial(setup_git, args)),
+        pipeline.Stage('upload_repos',
+                       st.UPLOAD_REPO_START, st.UPLOAD_REPO_END,
+                       functools.partial(upload_repos, args),
+                       requires=repo_steps),
+        pipeline.Stage('install_some_packages',
+                       st.INSTALL_PKG_START, st.INSTALL_PKG_END,
+                       functools.partial(install_some_packages, args)),
+        pipeline.Stage('clone_devstack',
+                       st.CLONE_STACK_START, st.CLONE_STACK_END,
+                       functools.partial(clone_devstack, args),
+                       requires=artifact_steps),
+        # Applying patches (again) on top of applied ones fails, so this
+        # is not retried (if its connection drops).
+        pipeline.Stage('patch_devstack',
+                       st.PATCH_STACK_START, st.PATCH_STACK_END,
+                       functools.partial(patch_devstack, args), retries=0,
+                       requires=artifact_steps),
+        pipeline.Stage('upload_extras',
+                       st.UPLOAD_EXTRAS_START, st.UPLOAD_EXTRAS_END,
+                       functools.partial(upload_extras, args),
+                       requires=artifact_steps),
+        # This needs the database and rabbit servers hostnames.
+        pipeline.Stage('create_local_files',
+                       st.CREATE_LOCAL_START, st.CREATE_LOCAL_END,
+                       functools.partial(create_local_files, args),
+                       requires=['show_hostnames']),
     ]
-    for (pre_state, post_state, func, func_on_done) in states:
-        if isinstance(func, functools.partial):
-            func_details = func.func.__doc__
-            func_name = reflection.get_callable_name(func.func)
-        else:
-            func_name = reflection.get_callable_name(func)
-            func_details = func.__doc__
-        helper.maybe_run(pre_state, post_state, func,
-                         func_on_done=func_on_done,
-                         func_details=func_details,
-                         func_name=func_name)
+    if args.wheelhouse:
+        stages.append(pipeline.Stage(
+            'install_wheelhouse', st.WHEELHOUSE_START, st.WHEELHOUSE_END,
+            functools.partial(install_wheelhouse, args),
+            # Copying the wheels (over ssh) needs the known hosts.
+            requires=['build_wheelhouse', 'adjust_known_hosts'],
+            last_result_from='build_wheelhouse'))
+    if args.git_mirror:
+        stages.append(pipeline.Stage(
+            'seed_opt_stack', st.SEED_REPOS_START, st.SEED_REPOS_END,
+            functools.partial(seed_opt_stack, args),
+            # Cloning from the mirror (over ssh) needs the known hosts.
+            requires=['mirror_git_repos', 'adjust_known_hosts']))
+    steps = [
+        pipeline.ClusterStep('show_hostnames', on_done_show_hostnames,
+                             after='bind_hostname'),
+        pipeline.ClusterStep('gather_ssh_keys',
+                             functools.partial(gather_ssh_keys, args),
+                             after='bind_hostname'),
+        pipeline.ClusterStep('adjust_known_hosts',
+                             on_done_adjust_known_hosts,
+                             after='interconnect_ssh'),
+    ]
+    if args.git_mirror:
+        steps.append(pipeline.ClusterStep(
+            'mirror_git_repos', functools.partial(mirror_git_repos, args),
+            after='create_local_files'))
+    if args.package_cache:
+        steps.append(pipeline.ClusterStep(
+            'prefetch_packages', functools.partial(prefetch_packages, args),
+            after='bind_hostname'))
+    if args.wheelhouse:
+        # This uses devstack tools (to get what is needed to build).
+        steps.append(pipeline.ClusterStep(
+            'build_wheelhouse', functools.partial(build_wheelhouse, args),
+            after='clone_devstack'))
+    if args.broadcast_fanout:
+        steps.append(pipeline.ClusterStep(
+            'broadcast_artifacts', functools.partial(broadcast_artifacts,
+                                                     args),
+            after='interconnect_ssh'))
+    pipeline.run_stages(helper, stages, steps,
+                        max_workers=args.max_workers, prepare=prepare)
 
     print("Creating (and/or adjusting) overlay network.")
     create_overlay(args, helper, indent="  ")
@@ -682,6 +1383,7 @@ def transform(args, helper):
 
 def create(args, cloud, tracker):
     """Creates/continues building a new environment."""
+    recorder = utils.Recorder(tracker, clock=args.clock)
     with utils.Spinner("Validating arguments against cloud", args.verbose):
         # Due to some funkiness with our openstack we have to list out
         # the az's and pick one, typically favoring ones with 'cor' in there
@@ -732,27 +1434,23 @@ def create(args, cloud, tracker):
     topo = fill_topo(args, cloud, tracker,
                      create_topo(args, cloud, tracker, curr_servers),
                      az_selector, flavors, image)
-    existing_servers, new_servers = bake_servers(args, cloud,
-                                                 tracker, topo,
-                                                 curr_servers)
-    wait_servers(args, cloud, tracker, existing_servers + new_servers)
-    # Now turn those servers into something useful...
-    max_workers = min(args.max_workers,
-                      len(existing_servers) + len(new_servers))
-    with utils.BuildHelper(cloud, tracker, topo) as helper:
-        futs = []
-        with utils.Spinner("Validating ssh connectivity"
-                           " using %s threads" % (max_workers),
-                           args.verbose):
-            with futurist.ThreadPoolExecutor(max_workers=max_workers) as ex:
-                for server in helper.iter_servers():
-                    fut = ex.submit(utils.ssh_connect,
-                                    server.ip, indent="  ",
-                                    user=DEF_USER, password=DEF_PW,
-                                    server_name=server.name,
-                                    verbose=args.verbose)
-                    futs.append((fut, server))
-        for fut, server in futs:
-            helper.bind_machine(server.name, fut.result())
+    with recorder.time_step('bake_servers'):
+        existing_servers, new_servers = bake_servers(args, cloud,
+                                                     tracker, recorder,
+                                                     topo, curr_servers)
+    # Now turn those servers into something useful, each server is waited
+    # on (to become ACTIVE) and connected to on its own and then starts
+    # being transformed right away (only cluster wide steps wait on all
+    # servers). Servers are only connected to once something needs to
+    # be done on them (so resuming skips connecting to finished servers).
+    connector = functools.partial(connect_server, args, cloud, recorder,
+                                  indent="  ")
+    with utils.BuildHelper(cloud, tracker, topo, recorder=recorder,
+                           connector=connector) as helper:
+        print("Waiting for, connecting to and transforming %s"
+              " servers." % helper.server_count)
+        prepare = functools.partial(boot_and_connect, helper)
         # And they said, turn it into a cloud...
-        transform(args, helper)
+        transform(args, helper, prepare=prepare)
+        if args.simulate:
+            simulate.print_predictions(helper)
@@ -0,0 +1,214 @@
+from __future__ import print_function
+
+import json
+import os
+import socket
+import sys
+import threading
+import traceback
+
+import six
+from six.moves import socketserver
+
+from builder import cows
+
+# Output lines (sent back to a client) starting with this carry the exit
+# code of the command the client asked to run (and end the output).
+EXIT_MARKER = "@@exit"
+
+# Options (that affect which cloud or state is used) that a command sent
+# to a daemon must agree with the daemon on.
+_PINNED_OPTIONS = ('cloud', 'cloud_region', 'state', 'state_format',
+                   'simulate')
+
+
+def bind_subparser(subparsers):
+    parser_daemon = subparsers.add_parser('daemon')
+    parser_daemon.set_defaults(func=serve)
+    return parser_daemon
+
+
+def post_process_args(args):
+    if getattr(args, 'daemon_socket', None) is None:
+        args.daemon_socket = "%s.sock" % args.state
+    return args
+
+
+class _SharedMachine(object):
+    """Machine (kept by a daemon) that those it is lent to can not close."""
+
+    def __init__(self, machine):
+        self._machine = machine
+
+    def __getattr__(self, name):
+        return getattr(self._machine, name)
+
+    def __getitem__(self, cmd):
+        return self._machine[cmd]
+
+    def close(self):
+        pass
+
+
+class KeptConnector(object):
+    """Connector that keeps (and reuses) the connections it makes.
+
+    Connections made for one command are lent (and not closed) to the
+    commands after it, as long as they are still alive.
+    """
+
+    def __init__(self, connector):
+        self._connector = connector
+        self._machines = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, ip, user=None, server_name=None, **kwargs):
+        key = (ip, user, server_name)
+        with self._lock:
+            machine = self._machines.pop(key, None)
+        if machine is not None:
+            is_alive = getattr(machine, 'is_alive', None)
+            if is_alive is None or is_alive():
+                with self._lock:
+                    self._machines[key] = machine
+                return _SharedMachine(machine)
+            machine.close()
+        machine = self._connector(ip, user=user, server_name=server_name,
+                                  **kwargs)
+        with self._lock:
+            self._machines[key] = machine
+        return _SharedMachine(machine)
+
+    def close(self):
+        with self._lock:
+            machines, self._machines = list(self._machines.values()), {}
+        for machine in machines:
+            machine.close()
+
+
+class _SocketWriter(object):
+    """Stands in for (a commands) stdout, sending output to a client."""
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self._lock = threading.Lock()
+        self.at_line_start = True
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode("utf8")
+        if not data:
+            return
+        with self._lock:
+            self._wfile.write(data)
+            self.at_line_start = data.endswith(b"\n")
+
+    def flush(self):
+        with self._lock:
+            self._wfile.flush()
+
+    def isatty(self):
+        return False
+
+
+class _Server(socketserver.UnixStreamServer):
+    def __init__(self, path, runner):
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        self.runner = runner
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        # Whoever can connect can run commands (as us), so only we can.
+        os.chmod(self.server_address, 0o600)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode("utf8"))
+        out = _SocketWriter(self.wfile)
+        old_stdout = sys.stdout
+        sys.stdout = out
+        try:
+            try:
+                exit_code = self.server.runner(request['argv'],
+                                               request['cwd'])
+            except Exception:
+                traceback.print_exc(file=out)
+                cows.goodbye(False)
+                exit_code = 1
+        finally:
+            sys.stdout = old_stdout
+        if not out.at_line_start:
+            out.write("\n")
+        out.write("%s %s\n" % (EXIT_MARKER, exit_code))
+        out.flush()
+
+
+def serve(args, cloud, tracker):
+    """Serves commands (from clients) with a warm cloud, state and ssh."""
+    connector = KeptConnector(args.connector)
+
+    def runner(argv, cwd):
+        # Defaults (and relative paths) of commands are relative to the
+        # working directory, which has to be the same as the daemon's for
+        # them to mean the same thing to it.
+        if os.path.realpath(cwd) != os.path.realpath(os.getcwd()):
+            raise RuntimeError("Daemon runs in '%s' (not '%s'), commands"
+                               " must be ran from the same directory"
+                               % (os.getcwd(), cwd))
+        cmd_args = args.parser.parse_args(argv)
+        cmd_args = args.finish_args(cmd_args)
+        if cmd_args.func is serve:
+            raise RuntimeError("Can not run a daemon inside a daemon")
+        for option in _PINNED_OPTIONS:
+            if getattr(cmd_args, option) != getattr(args, option):
+                raise RuntimeError("Daemon was started with %s=%r (not"
+                                   " %r)" % (option, getattr(args, option),
+                                             getattr(cmd_args, option)))
+        cmd_args.connector = connector
+        cmd_args.clock = args.clock
+        print("Action: '%s' (via daemon)" % cmd_args.func.__doc__)
+        cmd_args.func(cmd_args, cloud, tracker)
+        cows.goodbye(True)
+        return 0
+
+    if os.path.exists(args.daemon_socket):
+        os.unlink(args.daemon_socket)
+    server = _Server(args.daemon_socket, runner)
+    print("Serving commands on '%s' (interrupt to stop)."
+          % args.daemon_socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.daemon_socket)
+        connector.close()
+
+
+def run_client(path, argv):
+    """Runs a command (through a daemon) returning its exit code."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        raise IOError("Could not connect to daemon at '%s': %s" % (path, e))
+    exit_code = 1
+    try:
+        request = json.dumps({'argv': list(argv),
+                              'cwd': os.getcwd()}) + "\n"
+        sock.sendall(request.encode("utf8"))
+        fh = sock.makefile('rb')
+        for line in fh:
+            line = line.decode("utf8", "replace")
+            if line.startswith(EXIT_MARKER + " "):
+                exit_code = int(line.split(" ", 1)[1])
+                break
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        fh.close()
+    finally:
+        sock.close()
+    return exit_code
@@ -74,7 +74,8 @@ def destroy(args, cloud, tracker):
                                for server in cloud.list_servers())
         topo_servers_by_name = extract_servers_in_topo(tracker)
         while maybe_servers:
-            server_name = maybe_servers.pop()
+            with tracker.lock:
+                server_name = maybe_servers.pop()
             if not args.all and server_name not in topo_servers_by_name:
                 continue
             else:
@@ -86,6 +87,7 @@ def destroy(args, cloud, tracker):
                             cloud.delete_server(server_name, wait=False)
                         else:
                             cloud.delete_server(server_name, wait=True)
-                tracker['maybe_servers'] = maybe_servers
-                delete_from_topo(server_name, tracker)
+                with tracker.lock:
+                    tracker['maybe_servers'] = maybe_servers
+                    delete_from_topo(server_name, tracker)
                 tracker.sync()
@@ -0,0 +1,259 @@
+from __future__ import print_function
+
+import collections
+import functools
+import threading
+
+import contextlib2
+import futurist
+from futurist import waiters
+from oslo_utils import reflection
+import six
+
+from builder import utils
+
+
+def _get_callable_details(func):
+    if isinstance(func, functools.partial):
+        return (reflection.get_callable_name(func.func),
+                func.func.__doc__)
+    else:
+        return (reflection.get_callable_name(func), func.__doc__)
+
+
+class Task(object):
+    """Some function to run once all the tasks it requires are done."""
+
+    def __init__(self, name, func, requires=(), priority=0, pool=None):
+        self.name = name
+        self.func = func
+        self.requires = frozenset(requires)
+        self.priority = priority
+        #: Name of the (extra) scheduler pool to run in (or none for
+        #: the default one).
+        self.pool = pool
+
+
+class Scheduler(object):
+    """Runs tasks (on a bounded number of threads) as soon as they can run.
+
+    Tasks that can run at the same time are started in priority order
+    (highest first); tasks that require a task that failed (or that
+    itself could not run) are not ran.
+
+    Extra named pools (each with its own number of threads) may be given
+    so that tasks that mostly wait (for example on a server to boot) do
+    not take up threads that other tasks could be doing work in.
+    """
+
+    def __init__(self, max_workers, pools=None):
+        self.pools = {None: max(1, max_workers)}
+        for pool, pool_workers in six.iteritems(pools or {}):
+            self.pools[pool] = max(1, pool_workers)
+        self.tasks = collections.OrderedDict()
+        self.results = {}
+        self.failures = collections.OrderedDict()
+
+    @property
+    def max_workers(self):
+        return self.pools[None]
+
+    def add(self, task):
+        if task.name in self.tasks:
+            raise ValueError("Task '%s' already added" % task.name)
+        if task.pool not in self.pools:
+            raise ValueError("Task '%s' uses unknown pool '%s'"
+                             % (task.name, task.pool))
+        self.tasks[task.name] = task
+        return task
+
+    def run(self):
+        for task in six.itervalues(self.tasks):
+            missing = [name for name in task.requires
+                       if name not in self.tasks]
+            if missing:
+                raise ValueError("Task '%s' requires unknown task/s %s"
+                                 % (task.name, sorted(missing)))
+        pending = dict(self.tasks)
+        running = {}
+        done = set()
+        with contextlib2.ExitStack() as stack:
+            executors = {}
+            for pool, pool_workers in six.iteritems(self.pools):
+                executors[pool] = stack.enter_context(
+                    futurist.ThreadPoolExecutor(max_workers=pool_workers))
+            while pending or running:
+                ready = [task for task in six.itervalues(pending)
+                         if task.requires.issubset(done)]
+                ready.sort(key=lambda task: task.priority, reverse=True)
+                in_use = collections.Counter(
+                    task.pool for task in six.itervalues(running))
+                for task in ready:
+                    if in_use[task.pool] >= self.pools[task.pool]:
+                        continue
+                    in_use[task.pool] += 1
+                    pending.pop(task.name)
+                    running[executors[task.pool].submit(task.func)] = task
+                if not running:
+                    # Whatever is left requires something that failed.
+                    break
+                finished, _not_finished = waiters.wait_for_any(
+                    list(running.keys()))
+                for fut in finished:
+                    task = running.pop(fut)
+                    fut_exc = fut.exception()
+                    if fut_exc is not None:
+                        self.failures[task.name] = fut_exc
+                    else:
+                        self.results[task.name] = fut.result()
+                        done.add(task.name)
+        return pending
+
+
+class Stage(object):
+    """A per-server stage (that moves a server from one state to another).
+
+    Each server goes through its stages (in state order) independently of
+    all other servers, unless a stage requires some cluster steps (which
+    only run once all servers have gone through some stage).
+    """
+
+    def __init__(self, name, pre_state, post_state, func,
+                 requires=(), last_result_from=None, retries=1):
+        self.name = name
+        self.pre_state = pre_state
+        self.post_state = post_state
+        self.func = func
+        self.requires = tuple(requires)
+        #: Cluster step whose result is passed as the ``last_result``.
+        self.last_result_from = last_result_from
+        #: Times to retry (if safe to run again) when a connection drops.
+        self.retries = retries
+
+
+class ClusterStep(object):
+    """A step that runs (once) after all servers have finished a stage."""
+
+    def __init__(self, name, func, after):
+        self.name = name
+        self.func = func
+        self.after = after
+
+
+def run_stages(helper, stages, steps, max_workers=1, indent='',
+               prepare=None, prepare_workers=None):
+    """Runs stages (and cluster steps) on the servers that need them.
+
+    If a prepare function is given it is called with each server that
+    has stages left to run (for example to wait for it to boot and
+    connect to it) before that server's first stage, each server starts
+    its stages as soon as it is prepared (cluster steps wait for all
+    servers to be prepared).
+    """
+    stages = sorted(stages, key=lambda stage: stage.pre_state)
+    servers = list(helper.iter_servers())
+    helper.recorder.record_graph(stages, steps)
+    if prepare_workers is None:
+        prepare_workers = len(servers)
+    sched = Scheduler(max_workers, pools={'prepare': prepare_workers})
+    lock = threading.Lock()
+    # Stage name -> servers that have not yet finished it (used to
+    # print when a stage starts and when it has finished everywhere).
+    remaining = {}
+    started = set()
+
+    def make_stage_runner(stage, server):
+        func_name, func_details = _get_callable_details(stage.func)
+
+        def runner():
+            with lock:
+                if stage.name not in started:
+                    started.add(stage.name)
+                    print("%sActivating function '%s'" % (indent, func_name))
+                    if func_details:
+                        print("%sDetails: '%s'" % (indent, func_details))
+            last_result = None
+            if stage.last_result_from:
+                last_result = sched.results["step:%s"
+                                            % stage.last_result_from]
+            helper.run_on_server(server, stage.pre_state, stage.post_state,
+                                 stage.func, last_result=last_result,
+                                 indent=indent + "  ", name=stage.name,
+                                 retries=stage.retries)
+            with lock:
+                remaining[stage.name].discard(server.name)
+                if not remaining[stage.name]:
+                    print("%sFunction '%s' has finished."
+                          % (indent, func_name))
+
+        return runner
+
+    def make_step_runner(step):
+        func_name, _func_details = _get_callable_details(step.func)
+
+        def runner():
+            with lock:
+                print("%sActivating cluster step '%s'" % (indent, func_name))
+            with helper.recorder.time_step(step.name):
+                result = step.func(helper, indent=indent + "  ")
+            with lock:
+                print("%sCluster step '%s' has finished."
+                      % (indent, func_name))
+            return result
+
+        return runner
+
+    # Build what each server has to do (skipping what it already did).
+    server_tasks = collections.defaultdict(dict)
+    prepare_tasks = []
+    for server in servers:
+        prior = None
+        if prepare is not None and any(server.builder_state <
+                                       stage.post_state
+                                       for stage in stages):
+            prior = "prepare:%s" % server.name
+            sched.add(Task(prior, functools.partial(prepare, server),
+                           priority=1, pool='prepare'))
+            prepare_tasks.append(prior)
+        for stage in stages:
+            if server.builder_state >= stage.post_state:
+                continue
+            name = "%s:%s" % (stage.name, server.name)
+            requires = set("step:%s" % step for step in stage.requires)
+            if prior is not None:
+                requires.add(prior)
+            sched.add(Task(name, make_stage_runner(stage, server),
+                           requires=requires, priority=-stage.pre_state))
+            remaining.setdefault(stage.name, set()).add(server.name)
+            server_tasks[stage.name][server.name] = name
+            prior = name
+    # Now the cluster steps (that run once all servers are past a stage),
+    # only those that something still needs (or that follow a stage that
+    # ran on some server) are ran.
+    needed_steps = set()
+    for task in list(sched.tasks.values()):
+        needed_steps.update(name for name in task.requires
+                            if name.startswith("step:"))
+    for step in steps:
+        name = "step:%s" % step.name
+        if name not in needed_steps and not server_tasks[step.after]:
+            continue
+        requires = set(server_tasks[step.after].values())
+        requires.update(prepare_tasks)
+        sched.add(Task(name, make_step_runner(step),
+                       requires=requires, priority=1))
+    not_ran = sched.run()
+    helper.tracker.flush()
+    check_failures(sched, not_ran)
+
+
+def check_failures(sched, not_ran):
+    """Raises (for a ran scheduler) if any of its tasks failed or not ran."""
+    if sched.failures or not_ran:
+        fail_buf = six.StringIO()
+        for name, exc in six.iteritems(sched.failures):
+            fail_buf.write("Running '%s' failed: %s\n" % (name, exc))
+        if not_ran:
+            fail_buf.write("Not ran (due to prior failures): %s\n"
+                           % ", ".join(sorted(not_ran)))
+        raise utils.StageFailed(fail_buf.getvalue().rstrip())
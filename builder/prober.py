@@ -0,0 +1,150 @@
+import errno
+import random
+import socket
+import threading
+
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
+
+from monotonic import monotonic as now
+
+_IN_PROGRESS = frozenset([0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+                          errno.EALREADY])
+
+
+class _Probe(object):
+    def __init__(self, address):
+        self.address = address
+        self.ready = threading.Event()
+        self.sock = None
+        self.connected = False
+        self.buf = b""
+        self.started_at = None
+        self.failures = 0
+        self.next_at = 0.0
+        self.waiters = 0
+
+
+class SshProber(object):
+    """Probes (many) hosts for ssh readiness from a single selector loop.
+
+    A host is ready once a (non-blocking) tcp connect to it works and it
+    sends its ssh banner (a line starting with ``SSH-``); until then
+    each host is probed again after a short (jittered and capped) delay.
+    The loop runs in a thread that only exists while hosts are pending.
+    """
+
+    def __init__(self, attempt_timeout=2.0, retry_delay=0.25,
+                 max_retry_delay=2.0, tick=0.1):
+        self.attempt_timeout = attempt_timeout
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.tick = tick
+        self._lock = threading.Lock()
+        self._probes = {}
+        self._thread = None
+
+    def wait(self, host, port=22, timeout=None):
+        """Waits for a host to be ready (returns false if it never was)."""
+        address = (host, port)
+        with self._lock:
+            probe = self._probes.get(address)
+            if probe is None:
+                probe = self._probes[address] = _Probe(address)
+            probe.waiters += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        # The probe is shared (by all waiting on the same host) and is
+        # dropped once it is ready (or nobody is waiting on it anymore).
+        ready = probe.ready.wait(timeout)
+        with self._lock:
+            probe.waiters -= 1
+            if not probe.waiters:
+                self._probes.pop(address, None)
+        return ready
+
+    def _start(self, sel, probe):
+        probe.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.sock.setblocking(0)
+        probe.connected = False
+        probe.buf = b""
+        probe.started_at = now()
+        err = probe.sock.connect_ex(probe.address)
+        if err not in _IN_PROGRESS:
+            self._fail(sel, probe, register=False)
+        else:
+            sel.register(probe.sock, selectors.EVENT_WRITE, probe)
+
+    def _stop(self, sel, probe, register=True):
+        if register:
+            sel.unregister(probe.sock)
+        probe.sock.close()
+        probe.sock = None
+
+    def _fail(self, sel, probe, register=True):
+        self._stop(sel, probe, register=register)
+        probe.failures += 1
+        delay = min(self.max_retry_delay,
+                    self.retry_delay * (2 ** min(probe.failures, 8)))
+        probe.next_at = now() + random.uniform(delay / 2.0, delay)
+
+    def _check(self, sel, probe):
+        if not probe.connected:
+            err = probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._fail(sel, probe)
+            else:
+                probe.connected = True
+                sel.modify(probe.sock, selectors.EVENT_READ, probe)
+            return
+        try:
+            data = probe.sock.recv(256)
+        except socket.error:
+            data = b""
+        if not data:
+            self._fail(sel, probe)
+            return
+        probe.buf += data
+        if b"\n" in probe.buf or len(probe.buf) >= 255:
+            if probe.buf.startswith(b"SSH-"):
+                self._stop(sel, probe)
+                with self._lock:
+                    self._probes.pop(probe.address, None)
+                probe.ready.set()
+            else:
+                self._fail(sel, probe)
+
+    def _run(self):
+        sel = selectors.DefaultSelector()
+        try:
+            while True:
+                with self._lock:
+                    probes = list(self._probes.values())
+                    if not probes:
+                        self._thread = None
+                        return
+                for probe in probes:
+                    if probe.sock is None and now() >= probe.next_at:
+                        self._start(sel, probe)
+                for key, _events in sel.select(timeout=self.tick):
+                    self._check(sel, key.data)
+                with self._lock:
+                    dropped = [probe for probe in probes
+                               if probe.address not in self._probes]
+                for probe in probes:
+                    if probe.sock is None:
+                        continue
+                    if probe in dropped:
+                        self._stop(sel, probe)
+                    elif now() - probe.started_at > self.attempt_timeout:
+                        self._fail(sel, probe)
+        finally:
+            sel.close()
+
+
+#: Shared prober (so that all hosts get probed from one loop).
+PROBER = SshProber()
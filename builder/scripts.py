@@ -0,0 +1,116 @@
+import base64
+import collections
+
+import six
+
+from builder import utils
+
+# Lines of script output starting with this carry an operation's result.
+RESULT_MARKER = "@@result"
+
+# Lines of a script starting with this name an operation (so that things
+# that can not run the script, like a simulated machine, can still tell
+# which operations it has).
+OP_MARKER = "# @@op"
+
+Result = collections.namedtuple('Result', ['name', 'exit_code', 'output'])
+
+_PREAMBLE = """\
+# The script comes in over stdin, which is not left for what it runs.
+exec < /dev/null
+__report() {
+    printf '%s %%s %%s ' "$1" "$2"
+    printf '%%s' "$3" | base64 | tr -d '\\n'
+    printf '\\n'
+}
+""" % RESULT_MARKER
+
+
+class Script(object):
+    """Many (shell) operations that run on a server in a single exec.
+
+    Each operation's exit code and (combined stdout and stderr) output
+    is reported back; once an operation that is checked fails the
+    operations after it do not run (and running the script raises).
+    """
+
+    def __init__(self):
+        self.ops = collections.OrderedDict()
+
+    def add(self, name, command, check=True):
+        """Adds an operation (a snippet of shell) to the script."""
+        if name in self.ops:
+            raise ValueError("Operation '%s' already added" % name)
+        self.ops[name] = (command, check)
+
+    def write_file(self, name, path, contents, mode=None, check=True):
+        """Adds an operation that writes a file (with the given contents)."""
+        if isinstance(contents, six.text_type):
+            contents = contents.encode("utf8")
+        encoded = base64.b64encode(contents).decode("ascii")
+        command = "printf '%%s' %s | base64 -d > %s" % (
+            encoded, six.moves.shlex_quote(path))
+        if mode is not None:
+            command += " && chmod %o %s" % (mode,
+                                            six.moves.shlex_quote(path))
+        self.add(name, command, check=check)
+
+    def render(self):
+        # All of it is one compound command, so that bash reads (and
+        # parses) all of it before running any of it.
+        lines = ["{", _PREAMBLE]
+        for name, (command, check) in six.iteritems(self.ops):
+            lines.append("%s %s" % (OP_MARKER, name))
+            lines.append("__out=$( { %s\n} 2>&1 ); __rc=$?" % command)
+            lines.append("__report %s $__rc \"$__out\"" % name)
+            if check:
+                lines.append("[ $__rc -eq 0 ] || exit $__rc")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def run(self, machine):
+        """Runs the script (returning the results of its operations).
+
+        The script is piped into (the stdin of) bash, so it is shipped to
+        the server and ran with a single exec.
+        """
+        proc = machine['bash'].popen(['-s'])
+        stdout, stderr = utils.feed_process(proc,
+                                            self.render().encode("utf8"))
+        stdout = _to_text(stdout)
+        stderr = _to_text(stderr)
+        results = parse_results(stdout)
+        for name, (_command, check) in six.iteritems(self.ops):
+            result = results.get(name)
+            if result is None:
+                raise utils.RemoteExecutionFailed(
+                    "Operation '%s' did not run on %s (the script"
+                    " running it died?): %s" % (
+                        name, machine.host,
+                        utils.trim_it(stderr, 1024, reverse=True)))
+            if check and result.exit_code != 0:
+                raise utils.RemoteExecutionFailed(
+                    "Operation '%s' on %s failed with exit code %s: %s" % (
+                        name, machine.host, result.exit_code,
+                        utils.trim_it(result.output, 1024, reverse=True)))
+        return results
+
+
+def _to_text(data):
+    if isinstance(data, six.binary_type):
+        return data.decode("utf8", "replace")
+    return data
+
+
+def parse_results(stdout):
+    """Extracts the results (of operations) from a scripts output."""
+    results = collections.OrderedDict()
+    for line in stdout.splitlines():
+        if not line.startswith(RESULT_MARKER + " "):
+            continue
+        pieces = line.split(" ", 3)
+        name, exit_code = pieces[1], int(pieces[2])
+        output = base64.b64decode(pieces[3] if len(pieces) > 3 else "")
+        results[name] = Result(name, exit_code,
+                               output.decode("utf8", "replace"))
+    return results
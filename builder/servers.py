@@ -0,0 +1,98 @@
+from builder import states as st
+from builder import utils
+
+
+class Server(object):
+    """Compact (fixed field) record of a single topology server.
+
+    Only what is needed to (re)find the server, connect to it and resume
+    building it is retained (flavors and images are referenced by id).
+    """
+
+    __slots__ = tuple([
+        'name',
+        'kind',
+        'builder_state',
+        'filled',
+        'id',
+        'image_id',
+        'flavor_id',
+        'availability_zone',
+        'status',
+        'ip',
+        'hostname',
+        'timings',
+        'uploads',
+    ])
+
+    def __init__(self, name, kind, builder_state=st.NO_STATE, **kwargs):
+        for field in self.__slots__:
+            setattr(self, field, kwargs.pop(field, None))
+        if kwargs:
+            raise TypeError("Unknown server fields: %s" % sorted(kwargs))
+        self.name = name
+        self.kind = kind
+        self.builder_state = builder_state
+        if self.filled is None:
+            self.filled = False
+        if self.timings is None:
+            self.timings = {}
+        if self.uploads is None:
+            self.uploads = {}
+
+    @classmethod
+    def from_munch(cls, server):
+        """Converts a (prior style) full munch server into a compact one."""
+        fields = {}
+        for field in cls.__slots__:
+            if field in server:
+                fields[field] = server[field]
+        for field, munch_field in [('image_id', 'image'),
+                                   ('flavor_id', 'flavor')]:
+            thing = server.get(munch_field)
+            if thing:
+                fields[field] = thing['id']
+        if not fields.get('ip'):
+            fields['ip'] = utils.get_server_ip(server)
+        return cls(**fields)
+
+    def merge(self, cloud_server):
+        """Merges (only the wanted) details of a cloud server into this one."""
+        self.id = cloud_server['id']
+        self.status = cloud_server.get('status')
+        self.ip = utils.get_server_ip(cloud_server)
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.__slots__)
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        for field in self.__slots__:
+            setattr(self, field, state.get(field))
+
+    def __repr__(self):
+        return "<%s name=%r kind=%s builder_state=%s>" % (
+            type(self).__name__, self.name,
+            getattr(self.kind, 'name', self.kind), self.builder_state)
+
+
+def compact_topo(topo):
+    """Converts any (prior style) munch servers in a topology to compact ones.
+
+    Returns how many were converted.
+    """
+    converted = 0
+    compute = []
+    for server in topo['compute']:
+        if not isinstance(server, Server):
+            server = Server.from_munch(server)
+            converted += 1
+        compute.append(server)
+    topo['compute'] = compute
+    for kind, server in list(topo['control'].items()):
+        if not isinstance(server, Server):
+            topo['control'][kind] = Server.from_munch(server)
+            converted += 1
+    return converted
@@ -0,0 +1,390 @@
+from __future__ import print_function
+
+import collections
+import json
+import os
+import posixpath
+import random
+import threading
+import time
+import uuid
+
+import munch
+import six
+
+from monotonic import monotonic as now
+
+import builder as bu
+from builder import scripts
+
+# Default (mean, standard deviation) latencies (in seconds) of simulated
+# operations; commands are looked up by their base name, first suffixed
+# with ':<server name prefix>' (the prefix being what is before the first
+# dash in a servers name, for example 'map' or 'hv') so that commands can
+# take different amounts of time for different roles.
+DEF_LATENCIES = {
+    # Cloud operations.
+    'create_server': (1.0, 0.5),
+    'boot': (90.0, 45.0),
+    'delete_server': (5.0, 2.0),
+    'ssh_connect': (2.0, 1.0),
+    # Machine operations.
+    'command': (0.5, 0.2),
+    'git': (5.0, 2.0),
+    'yum': (60.0, 20.0),
+    'install_prereqs.sh': (240.0, 60.0),
+    'stack.sh': (600.0, 120.0),
+    'stack.sh:db': (300.0, 60.0),
+    'stack.sh:rb': (300.0, 60.0),
+    'stack.sh:map': (900.0, 180.0),
+    'stack.sh:cap': (900.0, 180.0),
+}
+
+# Commands that (may) get ran via sudo (the command that really runs is
+# the one after it).
+PREFIX_COMMANDS = frozenset(['sudo'])
+
+
+def load_latencies(path):
+    """Loads latencies (a json object of name => [mean, stddev])."""
+    latencies = dict(DEF_LATENCIES)
+    if path:
+        with open(path, 'r') as fh:
+            for name, (mean, stddev) in six.iteritems(json.load(fh)):
+                latencies[name] = (float(mean), float(stddev))
+    return latencies
+
+
+class Latencies(object):
+    """Samples (and sleeps for) how long simulated operations take.
+
+    Simulated time runs ``speedup`` times faster than real time, the
+    ``clock`` is a (monotonic) clock that runs at simulated speed.
+    """
+
+    def __init__(self, latencies=None, speedup=1.0, seed=None):
+        if latencies is None:
+            latencies = DEF_LATENCIES
+        self.latencies = latencies
+        self.speedup = speedup
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def clock(self):
+        return now() * self.speedup
+
+    def sample(self, name, server_name=None):
+        mean, stddev = None, None
+        if server_name:
+            prefix = server_name.split("-", 1)[0]
+            mean, stddev = self.latencies.get("%s:%s" % (name, prefix),
+                                              (None, None))
+        if mean is None:
+            mean, stddev = self.latencies.get(
+                name, self.latencies['command'])
+        with self._lock:
+            return max(0.0, self._random.gauss(mean, stddev))
+
+    def sleep(self, name, server_name=None):
+        time.sleep(self.sample(name, server_name=server_name) / self.speedup)
+
+
+class _AvailabilityZones(object):
+    def __init__(self, zones):
+        self._zones = zones
+
+    def list(self, detailed=True):
+        return [munch.Munch(zoneName=zone) for zone in self._zones]
+
+
+class _NovaClient(object):
+    def __init__(self, zones):
+        self.availability_zones = _AvailabilityZones(zones)
+
+
+class SimulatedCloud(object):
+    """Stand-in for a shade cloud (for the bits of it that are used).
+
+    Servers are kept in a (json) file so that later runs (for example
+    a destroy after a create) see the servers prior runs made.
+    """
+
+    def __init__(self, path, latencies, zones=('simulated',)):
+        self.path = path
+        self.latencies = latencies
+        self.auth = {
+            'auth_url': 'simulated://%s' % os.path.abspath(path),
+            'username': 'simulated',
+            'project_name': 'simulated',
+        }
+        self.region_name = None
+        self.nova_client = _NovaClient(zones)
+        self._lock = threading.Lock()
+        self._servers = {}
+        if os.path.exists(path):
+            with open(path, 'r') as fh:
+                self._servers = json.load(fh)
+
+    def _save(self):
+        tmp_path = "%s.%s.tmp" % (self.path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            json.dump(self._servers, fh, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def _make_server(self, server):
+        server = munch.Munch(server)
+        if time.time() >= server.pop('active_at'):
+            server['status'] = 'ACTIVE'
+        else:
+            server['status'] = 'BUILD'
+            server['private_v4'] = None
+        return server
+
+    def _find(self, name_or_id):
+        for server in six.itervalues(self._servers):
+            if name_or_id in (server['name'], server['id']):
+                return server
+        return None
+
+    def list_servers(self):
+        with self._lock:
+            return [self._make_server(server)
+                    for server in six.itervalues(self._servers)]
+
+    def get_server(self, name_or_id):
+        with self._lock:
+            server = self._find(name_or_id)
+            if server is None:
+                return None
+            return self._make_server(server)
+
+    def create_server(self, name, image, flavor, wait=False, **kwargs):
+        self.latencies.sleep('create_server', server_name=name)
+        boot = self.latencies.sample('boot', server_name=name)
+        with self._lock:
+            ip = "10.%s.%s.%s" % (random.randint(0, 255),
+                                  random.randint(0, 255),
+                                  random.randint(1, 254))
+            self._servers[name] = {
+                'id': str(uuid.uuid4()),
+                'name': name,
+                'image': image,
+                'flavor': flavor,
+                'private_v4': ip,
+                'active_at': time.time() + boot / self.latencies.speedup,
+            }
+            self._save()
+            server = self._make_server(self._servers[name])
+        if wait:
+            server = self.wait_for_server(server)
+        return server
+
+    def wait_for_server(self, server, **kwargs):
+        with self._lock:
+            active_at = self._find(server['id'])['active_at']
+        delay = active_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return self.get_server(server['id'])
+
+    def delete_server(self, name_or_id, wait=False, **kwargs):
+        with self._lock:
+            server = self._find(name_or_id)
+            if server is None:
+                return False
+        if wait:
+            self.latencies.sleep('delete_server',
+                                 server_name=server['name'])
+        with self._lock:
+            self._servers.pop(server['name'], None)
+            self._save()
+        return True
+
+    def list_images(self):
+        return [munch.Munch(id='simulated-centos7', name='centos7-base-1',
+                            group='CentOS 7', status='active',
+                            protected=False, **{
+                                'os.spec': "CentOS Linux release 7",
+                                'os.family': 'linux',
+                            })]
+
+    def get_image(self, name_or_id):
+        for image in self.list_images():
+            if name_or_id in (image.id, image.name):
+                return image
+        return None
+
+    def get_flavor(self, name_or_id):
+        return munch.Munch(id=name_or_id, name=name_or_id)
+
+    def get_keypair(self, name_or_id):
+        return munch.Munch(id=name_or_id, name=name_or_id)
+
+    def connect(self, ip, indent="", user=None, password=None,
+                server_name=None, verbose=False, **kwargs):
+        """Stand-in for :py:func:`~builder.utils.ssh_connect`."""
+        self.latencies.sleep('ssh_connect', server_name=server_name)
+        return SimulatedMachine(ip, self.latencies, user=user,
+                                server_name=server_name)
+
+
+def _script_command_name(line):
+    # The line after an operation's marker is '__out=$( { <command>'.
+    args = line.split("{", 1)[-1].split()
+    while args and posixpath.basename(args[0]) in PREFIX_COMMANDS:
+        args.pop(0)
+    if not args:
+        return 'command'
+    return posixpath.basename(args[0])
+
+
+class SimulatedMachine(object):
+    """Stand-in for a (plumbum) ssh machine that only pretends to run."""
+
+    def __init__(self, host, latencies, user=None, server_name=None):
+        self.host = host
+        self.latencies = latencies
+        self.server_name = server_name
+        self.home = "/home/%s" % (user or bu.DEF_USER)
+        self.files = {}
+        self.dirs = set([self.home])
+        self._lock = threading.Lock()
+
+    def __getitem__(self, cmd):
+        return SimulatedCommand(self, [cmd])
+
+    def abspath(self, path):
+        if path.startswith("~"):
+            path = self.home + path[1:]
+        return posixpath.normpath(posixpath.join(self.home, path))
+
+    def run(self, argv, cwd=None):
+        args = list(argv)
+        while args and posixpath.basename(args[0]) in PREFIX_COMMANDS:
+            args.pop(0)
+        name = posixpath.basename(args[0])
+        self.latencies.sleep(name, server_name=self.server_name)
+        if name == 'hostname':
+            return "%s.simulated\n" % self.server_name
+        if name == 'ssh-keygen':
+            key_path = self.abspath(args[args.index("-f") + 1])
+            with self._lock:
+                self.files[key_path] = "simulated private key\n"
+                self.files[key_path + ".pub"] = (
+                    "ssh-rsa AAAASIMULATED %s\n" % self.server_name)
+        elif name == 'ssh-keyscan':
+            return "%s ssh-rsa AAAASIMULATED\n" % args[-1]
+        elif name == 'git' and len(args) > 1 and args[1] == 'clone':
+            with self._lock:
+                self.dirs.add(self.abspath(posixpath.join(cwd or "",
+                                                          args[-1])))
+        return ""
+
+    def popen(self, argv):
+        args = list(argv)
+        while args and posixpath.basename(args[0]) in PREFIX_COMMANDS:
+            args.pop(0)
+        if posixpath.basename(args[0]) == 'bash' and args[1:] == ['-s']:
+            self.latencies.sleep('bash', server_name=self.server_name)
+            return SimulatedProcess("", on_input=self._run_script)
+        return SimulatedProcess(self.run(argv))
+
+    def _run_script(self, script):
+        # Scripts can not really run, so just pretend all of their
+        # operations worked (and output nothing), each taking as long as
+        # its name (or else the command it starts with) takes.
+        if isinstance(script, six.binary_type):
+            script = script.decode("utf8")
+        results = []
+        lines = script.splitlines()
+        for i, line in enumerate(lines):
+            if not line.startswith(scripts.OP_MARKER + " "):
+                continue
+            name = line[len(scripts.OP_MARKER) + 1:]
+            latency_name = name
+            if name not in self.latencies.latencies:
+                latency_name = _script_command_name(lines[i + 1])
+            self.latencies.sleep(latency_name, server_name=self.server_name)
+            results.append("%s %s 0 " % (scripts.RESULT_MARKER, name))
+        return "\n".join(results) + "\n"
+
+    def close(self):
+        pass
+
+
+class SimulatedCommand(object):
+    def __init__(self, machine, argv):
+        self.machine = machine
+        self.argv = argv
+
+    def __getitem__(self, other):
+        if isinstance(other, SimulatedCommand):
+            return SimulatedCommand(self.machine, self.argv + other.argv)
+        if not isinstance(other, (tuple, list)):
+            other = [other]
+        return SimulatedCommand(self.machine,
+                                self.argv + [str(a) for a in other])
+
+    def formulate(self):
+        return list(self.argv)
+
+    def __call__(self, *args, **kwargs):
+        return self.machine.run(self.argv + [str(a) for a in args],
+                                cwd=kwargs.get('cwd'))
+
+    def run(self, args=(), retcode=0):
+        return (0, self.machine.run(self.argv + [str(a) for a in args]), "")
+
+    def popen(self, args=()):
+        return self.machine.popen(self.argv + [str(a) for a in args])
+
+
+class SimulatedProcess(object):
+    def __init__(self, output, on_input=None):
+        self.output = output
+        self.returncode = 0
+        self._on_input = on_input
+
+    def communicate(self, input=None):
+        if self._on_input is not None and input is not None:
+            self.output = self._on_input(input)
+        return (self.output, "")
+
+    def iter_lines(self):
+        for line in self.output.splitlines():
+            yield (line, None)
+
+
+def print_predictions(helper):
+    """Prints the (simulated) wall time each stage/step took."""
+    run_id = helper.tracker['timings']['run_id']
+    spans = collections.OrderedDict()
+    timings = []
+    for name, (t_run_id, start, end, _ok) in six.iteritems(
+            helper.tracker['timings']['steps']):
+        if t_run_id == run_id:
+            timings.append((start, end, name))
+    for server in helper.iter_servers():
+        for name, (t_run_id, start, end, _ok) in six.iteritems(
+                server.timings):
+            if t_run_id == run_id:
+                timings.append((start, end, name))
+    for start, end, name in sorted(timings):
+        if name in spans:
+            spans[name] = (spans[name][0], max(spans[name][1], end))
+        else:
+            spans[name] = (start, end)
+    print("Predicted wall time (per stage):")
+    for name, (start, end) in six.iteritems(spans):
+        print("  %-24s %9.2f seconds (from %0.2f to %0.2f)"
+              % (name, end - start, start, end))
+    if spans:
+        print("Predicted total wall time: %0.2f seconds"
+              % max(end for _start, end in six.itervalues(spans)))
+
+
+def make_cloud(state_path, latencies_path=None, speedup=1.0, seed=None):
+    """Makes a simulated cloud (whose servers are kept next to the state)."""
+    latencies = Latencies(load_latencies(latencies_path),
+                          speedup=speedup, seed=seed)
+    return SimulatedCloud("%s.simulated" % state_path, latencies)
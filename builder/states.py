@@ -29,5 +29,11 @@ UPLOAD_EXTRAS_END = UPLOAD_EXTRAS_START + 1
 CREATE_LOCAL_START = 80
 CREATE_LOCAL_END = CREATE_LOCAL_START + 1
 
+SEED_REPOS_START = 90
+SEED_REPOS_END = SEED_REPOS_START + 1
+
+WHEELHOUSE_START = 95
+WHEELHOUSE_END = WHEELHOUSE_START + 1
+
 STACK_SH_START = 100
 STACK_SH_END = STACK_SH_START + 1
@@ -0,0 +1,822 @@
+import contextlib
+import errno
+import fcntl
+import functools
+import os
+import pickle
+import sqlite3
+import struct
+import threading
+import zlib
+
+from oslo_utils import units
+import six
+
+from builder.roles import Roles
+
+# Record header (crc32 of meta + blob, meta length, blob length).
+_HEADER = struct.Struct("!III")
+
+
+def explode(cloud):
+    """Splits a clouds data into small independently persistable records.
+
+    Each topology server becomes its own record (so that a single server
+    changing its state only produces a single tiny record), everything else
+    is kept as a record per top-level key.
+    """
+    records = {}
+    for key, value in six.iteritems(cloud):
+        if key == 'topo' and isinstance(value, dict):
+            skeleton = dict(value)
+            compute = skeleton.pop('compute', [])
+            control = skeleton.pop('control', {})
+            skeleton['compute'] = len(compute)
+            skeleton['control'] = list(control.keys())
+            records[('topo',)] = skeleton
+            for i, server in enumerate(compute):
+                records[('topo', 'compute', i)] = server
+            for kind, server in six.iteritems(control):
+                records[('topo', 'control', kind)] = server
+        else:
+            records[(key,)] = value
+    return records
+
+
+def explode_changed(cloud, changes):
+    """Explodes only what changed in a clouds data (see ``explode``).
+
+    The changes are a tuple of changed top-level keys and changed (topology)
+    servers, or none if anything may have changed. Returns the records
+    along with the top-level keys whose records were all made again (and
+    so any prior records of those keys that were not made again were
+    deleted), or none if that is all of them.
+    """
+    if changes is None:
+        return explode(cloud), None
+    keys, servers = changes
+    records = {}
+    for key in keys:
+        if key in cloud:
+            records.update(explode({key: cloud[key]}))
+    topo = cloud.get('topo')
+    if servers and topo and 'topo' not in keys:
+        # Matched by identity (which avoids comparing, or pickling, any of
+        # the servers that did not change).
+        server_ids = set(id(server) for server in servers)
+        for i, server in enumerate(topo['compute']):
+            if id(server) in server_ids:
+                records[('topo', 'compute', i)] = server
+        for kind, server in six.iteritems(topo['control']):
+            if id(server) in server_ids:
+                records[('topo', 'control', kind)] = server
+    return records, frozenset(keys)
+
+
+def implode(records):
+    """Reforms a clouds data from records previously made by ``explode``."""
+    cloud = {}
+    for key, value in six.iteritems(records):
+        if len(key) != 1:
+            continue
+        if key == ('topo',):
+            topo = dict(value)
+            topo['compute'] = [records[('topo', 'compute', i)]
+                               for i in six.moves.range(value['compute'])]
+            topo['control'] = dict((kind, records[('topo', 'control', kind)])
+                                   for kind in value['control'])
+            cloud['topo'] = topo
+        else:
+            cloud[key[0]] = value
+    return cloud
+
+
+def write_record(fh, cloud_name, key, blob):
+    """Writes a single (checksummed) record (a none blob is a deletion)."""
+    meta = pickle.dumps((cloud_name, key, blob is None), -1)
+    if blob is None:
+        blob = b''
+    crc = zlib.crc32(blob, zlib.crc32(meta)) & 0xffffffff
+    fh.write(_HEADER.pack(crc, len(meta), len(blob)) + meta + blob)
+
+
+def iter_records(fh, cloud_name=None):
+    """Yields (cloud_name, key, blob) records from a file handle.
+
+    Stops at the first truncated or corrupt record (which is what a crash
+    in the middle of appending a record would leave behind). When a cloud
+    name is provided the blobs of records of other clouds are skipped over
+    (without being read).
+    """
+    while True:
+        header = fh.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return
+        crc, meta_len, blob_len = _HEADER.unpack(header)
+        meta = fh.read(meta_len)
+        if len(meta) < meta_len:
+            return
+        if cloud_name is not None:
+            if pickle.loads(meta)[0] != cloud_name:
+                fh.seek(blob_len, os.SEEK_CUR)
+                continue
+        blob = fh.read(blob_len)
+        if len(blob) < blob_len:
+            return
+        if zlib.crc32(blob, zlib.crc32(meta)) & 0xffffffff != crc:
+            return
+        r_cloud_name, key, deleted = pickle.loads(meta)
+        if deleted:
+            blob = None
+        yield r_cloud_name, key, blob
+
+
+def _server_matches(server, kinds=None, min_state=None, max_state=None):
+    if kinds and server.kind not in kinds:
+        return False
+    if min_state is not None and server.builder_state < min_state:
+        return False
+    if max_state is not None and server.builder_state >= max_state:
+        return False
+    return True
+
+
+def _iter_topo_servers(topo):
+    if not topo:
+        return
+    for server in topo['compute']:
+        yield server
+    for kind in sorted(topo['control'].keys()):
+        yield topo['control'][kind]
+
+
+class FileLock(object):
+    """Exclusive lock across threads *and* processes (using ``flock``)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fh = None
+
+    def acquire(self, blocking=True):
+        if not self._lock.acquire(blocking):
+            return False
+        try:
+            fh = open(self.path, 'a')
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(fh.fileno(), flags)
+            except IOError as e:
+                fh.close()
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    self._lock.release()
+                    return False
+                raise
+        except Exception:
+            self._lock.release()
+            raise
+        self._fh = fh
+        return True
+
+    def release(self):
+        fh, self._fh = self._fh, None
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+        finally:
+            fh.close()
+            self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def _remove_if_exists(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class PickleStore(object):
+    """Stores all clouds in a single pickle (rewritten on every save).
+
+    Multiple processes (working on different clouds) may share the same
+    pickle; each save re-reads the pickle (while holding a file lock) and
+    only replaces the cloud it was made for.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._clouds = {}
+        self._lock = FileLock("%s.lock" % path)
+
+    def _read(self):
+        try:
+            with open(self.path, 'rb') as fh:
+                fh_contents = fh.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                fh_contents = None
+            else:
+                raise
+        if fh_contents:
+            return pickle.loads(fh_contents)
+        else:
+            return {}
+
+    def load(self):
+        with self._lock:
+            self._clouds = self._read()
+        return self._clouds
+
+    def peek(self):
+        """Reads (without any side-effects) the currently stored clouds."""
+        # Saves replace the pickle (with a rename) so it can be read
+        # without the lock (and without creating it).
+        return self._read()
+
+    def cloud_names(self):
+        """Returns the names of the clouds that are stored."""
+        return sorted(self.peek().keys())
+
+    def iter_servers(self, cloud_name, kinds=None,
+                     min_state=None, max_state=None):
+        """Yields servers of a cloud (matching the given filters).
+
+        NOTE: this has to read all the clouds (the pickle is not indexed).
+        """
+        cloud = self.peek().get(cloud_name, {})
+        for server in _iter_topo_servers(cloud.get('topo')):
+            if _server_matches(server, kinds=kinds,
+                               min_state=min_state, max_state=max_state):
+                yield server
+
+    def make_saver(self, cloud_name, cloud):
+        """Makes a saver (of a cloud) for a tracker.
+
+        A saver gets called (with what changed, see ``explode_changed``)
+        and snapshots what it will save, returning a writer (or none if
+        there is nothing to write) that writes that snapshot out; only the
+        snapshotting has to be done while nothing changes the cloud.
+        """
+        self._clouds[cloud_name] = cloud
+
+        def saver(changes=None):
+            blob = pickle.dumps({cloud_name: cloud}, -1)
+
+            def writer():
+                with self._lock:
+                    # Merge with whatever other processes have saved (for
+                    # other clouds) since we last looked.
+                    clouds = self._read()
+                    clouds.pop(cloud_name, None)
+                    if clouds:
+                        clouds.update(pickle.loads(blob))
+                        data = pickle.dumps(clouds, -1)
+                    else:
+                        data = blob
+                    # Doing this ensures we perform this in a crash safe
+                    # manner, so that even if we get interrupted while
+                    # saving the original file is not messed up.
+                    tmp_path = "%s.%s.tmp" % (self.path, os.getpid())
+                    with open(tmp_path, 'wb') as fh:
+                        fh.write(data)
+                    os.rename(tmp_path, self.path)
+
+            return writer
+
+        return saver
+
+    def close(self):
+        pass
+
+
+class JournalStore(object):
+    """Appends small per-record deltas to a log (instead of full rewrites).
+
+    The log is (in the background) compacted into a snapshot once it grows
+    past a given size; on load the snapshot is read and any log(s) left
+    behind are replayed on top of it. Since every record holds the full
+    value of its key (and never a partial update) replaying a log that
+    was already folded into a snapshot is harmless, which is what keeps
+    this as crash safe as the prior tmp file + rename approach.
+
+    Multiple processes (working on different clouds) may share the same
+    journal; appends, log rotation and snapshot replacement all happen
+    while holding a file lock and compaction only uses what is on disk
+    (so it includes the records other processes appended).
+    """
+
+    def __init__(self, path, compact_after=4 * units.Mi):
+        self.path = path
+        self.log_path = "%s.log" % path
+        self.compacting_path = "%s.log.compacting" % path
+        self.compact_after = compact_after
+        self._blobs = {}
+        self._lock = FileLock("%s.lock" % path)
+        self._compact_lock = FileLock("%s.compact.lock" % path)
+        self._compactor = None
+        self._opened = False
+
+    def _replay(self, path, blobs, cloud_name=None):
+        try:
+            fh = open(path, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            else:
+                raise
+        with fh:
+            valid_upto = 0
+            for r_cloud_name, key, blob in iter_records(fh,
+                                                        cloud_name=cloud_name):
+                if blob is None:
+                    blobs.pop((r_cloud_name, key), None)
+                else:
+                    blobs[(r_cloud_name, key)] = blob
+                valid_upto = fh.tell()
+        return valid_upto
+
+    def _compact(self):
+        with self._compact_lock:
+            with self._lock:
+                if not os.path.exists(self.compacting_path):
+                    if not os.path.exists(self.log_path):
+                        return
+                    os.rename(self.log_path, self.compacting_path)
+            # Only compaction alters the snapshot and the compacting log
+            # (and we hold the compaction lock) so these can be read
+            # without blocking others from appending.
+            blobs = {}
+            self._replay(self.path, blobs=blobs)
+            self._replay(self.compacting_path, blobs=blobs)
+            tmp_path = "%s.%s.tmp" % (self.path, os.getpid())
+            with open(tmp_path, 'wb') as fh:
+                for (cloud_name, key), blob in six.iteritems(blobs):
+                    write_record(fh, cloud_name, key, blob)
+                fh.flush()
+                os.fsync(fh.fileno())
+            with self._lock:
+                os.rename(tmp_path, self.path)
+                _remove_if_exists(self.compacting_path)
+
+    def _maybe_compact(self):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self._compact)
+        self._compactor.daemon = True
+        self._compactor.start()
+
+    def _read(self, truncate_torn=False):
+        blobs = {}
+        with self._lock:
+            self._replay(self.path, blobs)
+            self._replay(self.compacting_path, blobs)
+            valid_upto = self._replay(self.log_path, blobs)
+            if truncate_torn and valid_upto is not None:
+                # Drop whatever a crashed prior run left partially
+                # written (so that new appends are not lost behind it).
+                if os.path.getsize(self.log_path) > valid_upto:
+                    with open(self.log_path, 'r+b') as fh:
+                        fh.truncate(valid_upto)
+        return blobs
+
+    def _inodes(self):
+        inodes = []
+        for path in [self.path, self.compacting_path, self.log_path]:
+            try:
+                inodes.append(os.stat(path).st_ino)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    inodes.append(None)
+                else:
+                    raise
+        return inodes
+
+    def _read_unlocked(self, read_func):
+        # Appends are crc checked and torn tails are skipped over, so
+        # the only thing to watch out for (without the lock) is a log
+        # rotation or snapshot replacement happening midway through;
+        # those swap out files, so just read again when that happens.
+        while True:
+            inodes = self._inodes()
+            result = read_func()
+            if self._inodes() == inodes:
+                return result
+
+    def _replay_all(self, cloud_name=None):
+        blobs = {}
+        for path in [self.path, self.compacting_path, self.log_path]:
+            self._replay(path, blobs, cloud_name=cloud_name)
+        return blobs
+
+    def _scan_cloud_names(self):
+        cloud_names = set()
+        for path in [self.path, self.compacting_path, self.log_path]:
+            try:
+                fh = open(path, 'rb')
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                else:
+                    raise
+            with fh:
+                while True:
+                    header = fh.read(_HEADER.size)
+                    if len(header) < _HEADER.size:
+                        break
+                    _crc, meta_len, blob_len = _HEADER.unpack(header)
+                    meta = fh.read(meta_len)
+                    if len(meta) < meta_len:
+                        break
+                    cloud_names.add(pickle.loads(meta)[0])
+                    fh.seek(blob_len, os.SEEK_CUR)
+        return cloud_names
+
+    @staticmethod
+    def _make_clouds(blobs):
+        clouds = {}
+        for (cloud_name, key), blob in six.iteritems(blobs):
+            clouds.setdefault(cloud_name, {})[key] = pickle.loads(blob)
+        for cloud_name, records in list(clouds.items()):
+            clouds[cloud_name] = implode(records)
+        return clouds
+
+    def peek(self):
+        """Reads (without any side-effects) the currently stored clouds."""
+        return self._make_clouds(self._read_unlocked(self._replay_all))
+
+    def cloud_names(self):
+        """Returns the names of the clouds that are stored."""
+        return sorted(self._read_unlocked(self._scan_cloud_names))
+
+    def iter_servers(self, cloud_name, kinds=None,
+                     min_state=None, max_state=None):
+        """Yields servers of a cloud (matching the given filters).
+
+        Only the records of the given cloud are read (the blobs of other
+        clouds are skipped over) and only its servers get unpickled.
+        """
+        blobs = self._read_unlocked(
+            functools.partial(self._replay_all, cloud_name=cloud_name))
+        skeleton = blobs.get((cloud_name, ('topo',)))
+        if skeleton is None:
+            return
+        skeleton = pickle.loads(skeleton)
+        keys = [('topo', 'compute', i)
+                for i in six.moves.range(skeleton['compute'])]
+        keys.extend(('topo', 'control', kind)
+                    for kind in sorted(skeleton['control']))
+        for key in keys:
+            blob = blobs.pop((cloud_name, key), None)
+            if blob is None:
+                continue
+            server = pickle.loads(blob)
+            if _server_matches(server, kinds=kinds,
+                               min_state=min_state, max_state=max_state):
+                yield server
+
+    def load(self):
+        self._blobs = self._read(truncate_torn=True)
+        self._opened = True
+        return self._make_clouds(self._blobs)
+
+    def make_saver(self, cloud_name, cloud):
+
+        def saver(changes=None):
+            records, remade = explode_changed(cloud, changes)
+            blobs = {}
+            for key, value in six.iteritems(records):
+                blobs[(cloud_name, key)] = pickle.dumps(value, -1)
+            changed = []
+            for b_key, blob in six.iteritems(blobs):
+                if self._blobs.get(b_key) != blob:
+                    changed.append((b_key, blob))
+            if remade is None or remade:
+                for b_key in list(self._blobs.keys()):
+                    if (b_key[0] == cloud_name and b_key not in blobs and
+                            (remade is None or b_key[1][0] in remade)):
+                        changed.append((b_key, None))
+            if not changed:
+                return None
+
+            def writer():
+                with self._lock:
+                    # Reopened each time, since another process may have
+                    # rotated the log (to compact it) since we last
+                    # appended.
+                    with open(self.log_path, 'ab') as fh:
+                        for b_key, blob in changed:
+                            write_record(fh, cloud_name, b_key[1], blob)
+                        fh.flush()
+                        log_size = fh.tell()
+                    for b_key, blob in changed:
+                        if blob is None:
+                            self._blobs.pop(b_key, None)
+                        else:
+                            self._blobs[b_key] = blob
+                if log_size >= self.compact_after:
+                    self._maybe_compact()
+
+            return writer
+
+        return saver
+
+    def close(self):
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        if self._opened:
+            self._opened = False
+            # Twice, since a compaction that crashed earlier may have left
+            # behind a compacting log (which gets done first).
+            self._compact()
+            self._compact()
+
+
+class SqliteStore(object):
+    """Stores clouds in a sqlite3 database (as rows, in WAL mode).
+
+    Each topology server is its own row in the ``servers`` table (so that
+    a server changing its state only updates that one row); the settings
+    and maybe servers get their own tables and anything else is stored
+    in an ``items`` table.
+    """
+
+    SCHEMA = tuple([
+        "CREATE TABLE IF NOT EXISTS clouds"
+        " (name TEXT PRIMARY KEY)",
+        "CREATE TABLE IF NOT EXISTS servers"
+        " (cloud TEXT, plane TEXT, slot INTEGER,"
+        " name TEXT, kind INTEGER, builder_state INTEGER, data BLOB,"
+        " PRIMARY KEY (cloud, plane, slot))",
+        "CREATE INDEX IF NOT EXISTS servers_by_state"
+        " ON servers (cloud, builder_state)",
+        "CREATE TABLE IF NOT EXISTS settings"
+        " (cloud TEXT, name TEXT, value BLOB, PRIMARY KEY (cloud, name))",
+        "CREATE TABLE IF NOT EXISTS maybe_servers"
+        " (cloud TEXT, name TEXT, PRIMARY KEY (cloud, name))",
+        "CREATE TABLE IF NOT EXISTS items"
+        " (cloud TEXT, key TEXT, value BLOB, PRIMARY KEY (cloud, key))",
+    ])
+
+    def __init__(self, path, busy_timeout=30):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._blobs = {}
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path,
+                                         timeout=self.busy_timeout,
+                                         check_same_thread=False)
+            self._conn.text_factory = str
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            with self._conn:
+                for stmt in self.SCHEMA:
+                    self._conn.execute(stmt)
+        return self._conn
+
+    @staticmethod
+    def _expand(records):
+        # Splits the settings and maybe servers into a record per entry
+        # (so that they each map to a single row).
+        settings = records.pop(('settings',), None) or {}
+        for name, value in six.iteritems(settings):
+            records[('settings', name)] = value
+        maybe_servers = records.pop(('maybe_servers',), None) or ()
+        for name in maybe_servers:
+            records[('maybe_servers', name)] = True
+        return records
+
+    @staticmethod
+    def _collapse(records):
+        for key in list(records.keys()):
+            if len(key) == 2 and key[0] == 'settings':
+                settings = records.setdefault(('settings',), {})
+                settings[key[1]] = records.pop(key)
+            elif len(key) == 2 and key[0] == 'maybe_servers':
+                maybe_servers = records.setdefault(('maybe_servers',), set())
+                maybe_servers.add(key[1])
+                records.pop(key)
+        return records
+
+    @contextlib.contextmanager
+    def _reading(self):
+        # Reads use the (read-write) connection once there is one, until
+        # then a read-only one is used (so that reading never creates the
+        # database, or its schema).
+        if self._conn is not None:
+            yield self._conn
+            return
+        if not os.path.exists(self.path):
+            raise IOError(errno.ENOENT, "No sqlite state found", self.path)
+        uri = "file:%s?mode=ro" % six.moves.urllib.parse.quote(
+            os.path.abspath(self.path))
+        try:
+            conn = sqlite3.connect(uri, uri=True,
+                                   timeout=self.busy_timeout,
+                                   check_same_thread=False)
+        except TypeError:
+            # Older pythons can not open uris (so not read-only either).
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                                   check_same_thread=False)
+        conn.text_factory = str
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _iter_rows(conn, cloud_name=None):
+        params = ()
+        where = ""
+        if cloud_name is not None:
+            params = (cloud_name,)
+            where = " WHERE cloud = ?"
+        for cloud, plane, slot, data in conn.execute(
+                "SELECT cloud, plane, slot, data FROM servers" + where,
+                params):
+            if plane == 'control':
+                slot = Roles(slot)
+            yield cloud, ('topo', plane, slot), bytes(data)
+        for cloud, name, value in conn.execute(
+                "SELECT cloud, name, value FROM settings" + where, params):
+            yield cloud, ('settings', name), bytes(value)
+        for cloud, name in conn.execute(
+                "SELECT cloud, name FROM maybe_servers" + where, params):
+            yield cloud, ('maybe_servers', name), pickle.dumps(True, -1)
+        for cloud, key, value in conn.execute(
+                "SELECT cloud, key, value FROM items" + where, params):
+            yield cloud, (key,), bytes(value)
+
+    def _read(self, conn):
+        blobs = {}
+        for (cloud_name,) in conn.execute("SELECT name FROM clouds"):
+            blobs.setdefault(cloud_name, {})
+        for cloud_name, key, blob in self._iter_rows(conn):
+            blobs.setdefault(cloud_name, {})[key] = blob
+        return blobs
+
+    def _make_clouds(self, blobs):
+        clouds = {}
+        for cloud_name, cloud_blobs in six.iteritems(blobs):
+            records = dict((key, pickle.loads(blob))
+                           for key, blob in six.iteritems(cloud_blobs))
+            clouds[cloud_name] = implode(self._collapse(records))
+        return clouds
+
+    def peek(self):
+        """Reads (without any side-effects) the currently stored clouds."""
+        with self._reading() as conn:
+            return self._make_clouds(self._read(conn))
+
+    def load(self):
+        self._blobs = self._read(self._connect())
+        return self._make_clouds(self._blobs)
+
+    def cloud_names(self):
+        """Returns the names of the clouds that are stored."""
+        with self._reading() as conn:
+            return [cloud_name for (cloud_name,) in
+                    conn.execute("SELECT name FROM clouds ORDER BY name")]
+
+    def iter_servers(self, cloud_name, kinds=None,
+                     min_state=None, max_state=None):
+        """Yields servers of a cloud (using the indexes to filter them)."""
+        query = ["SELECT data FROM servers WHERE cloud = ?"]
+        params = [cloud_name]
+        if kinds:
+            query.append("AND kind IN (%s)" % ", ".join("?" * len(kinds)))
+            params.extend(int(kind) for kind in kinds)
+        if min_state is not None:
+            query.append("AND builder_state >= ?")
+            params.append(min_state)
+        if max_state is not None:
+            query.append("AND builder_state < ?")
+            params.append(max_state)
+        query.append("ORDER BY plane, slot")
+        with self._reading() as conn:
+            for (data,) in conn.execute(" ".join(query), params):
+                yield pickle.loads(bytes(data))
+
+    @staticmethod
+    def _columns(key, value):
+        # The (indexed) columns a record has (besides its blob).
+        if len(key) == 3:
+            return (getattr(value, 'name', None), int(value.kind),
+                    getattr(value, 'builder_state', None))
+        return None
+
+    def _save(self, conn, cloud_name, key, columns, blob):
+        if len(key) == 3:
+            plane, slot = key[1], int(key[2])
+            if blob is None:
+                conn.execute("DELETE FROM servers WHERE cloud = ?"
+                             " AND plane = ? AND slot = ?",
+                             (cloud_name, plane, slot))
+            else:
+                conn.execute("INSERT OR REPLACE INTO servers (cloud, plane,"
+                             " slot, name, kind, builder_state, data)"
+                             " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (cloud_name, plane, slot) + columns +
+                             (sqlite3.Binary(blob),))
+        elif len(key) == 2 and key[0] == 'settings':
+            if blob is None:
+                conn.execute("DELETE FROM settings WHERE cloud = ?"
+                             " AND name = ?", (cloud_name, key[1]))
+            else:
+                conn.execute("INSERT OR REPLACE INTO settings"
+                             " (cloud, name, value) VALUES (?, ?, ?)",
+                             (cloud_name, key[1], sqlite3.Binary(blob)))
+        elif len(key) == 2 and key[0] == 'maybe_servers':
+            if blob is None:
+                conn.execute("DELETE FROM maybe_servers WHERE cloud = ?"
+                             " AND name = ?", (cloud_name, key[1]))
+            else:
+                conn.execute("INSERT OR IGNORE INTO maybe_servers"
+                             " (cloud, name) VALUES (?, ?)",
+                             (cloud_name, key[1]))
+        else:
+            if blob is None:
+                conn.execute("DELETE FROM items WHERE cloud = ?"
+                             " AND key = ?", (cloud_name, key[0]))
+            else:
+                conn.execute("INSERT OR REPLACE INTO items"
+                             " (cloud, key, value) VALUES (?, ?, ?)",
+                             (cloud_name, key[0], sqlite3.Binary(blob)))
+
+    def make_saver(self, cloud_name, cloud):
+
+        def saver(changes=None):
+            records, remade = explode_changed(cloud, changes)
+            records = self._expand(records)
+            prior_blobs = self._blobs.setdefault(cloud_name, {})
+            changed = []
+            for key, value in six.iteritems(records):
+                blob = pickle.dumps(value, -1)
+                if prior_blobs.get(key) != blob:
+                    changed.append((key, self._columns(key, value), blob))
+            if remade is None or remade:
+                for key in list(prior_blobs.keys()):
+                    if key not in records and (remade is None or
+                                               key[0] in remade):
+                        changed.append((key, None, None))
+            if not changed:
+                return None
+
+            def writer():
+                with self._lock:
+                    conn = self._connect()
+                    with conn:
+                        conn.execute("INSERT OR IGNORE INTO clouds (name)"
+                                     " VALUES (?)", (cloud_name,))
+                        for key, columns, blob in changed:
+                            self._save(conn, cloud_name, key, columns, blob)
+                            if blob is None:
+                                prior_blobs.pop(key, None)
+                            else:
+                                prior_blobs[key] = blob
+
+            return writer
+
+        return saver
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+STORES = {
+    'pickle': PickleStore,
+    'journal': JournalStore,
+    'sqlite': SqliteStore,
+}
+
+#: Default file extension used for each kind of store.
+STORE_EXTENSIONS = {
+    'pickle': 'pkl',
+    'journal': 'jnl',
+    'sqlite': 'db',
+}
+
+
+def open_store(path, kind='pickle'):
+    """Creates a (not yet loaded) state store of the given kind."""
+    try:
+        store_cls = STORES[kind]
+    except KeyError:
+        raise ValueError("Unknown state store kind '%s'" % kind)
+    return store_cls(path)
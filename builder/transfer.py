@@ -0,0 +1,240 @@
+import collections
+import hashlib
+import io
+import os
+import posixpath
+import tarfile
+import time
+
+import futurist
+import six
+
+from builder import utils
+
+
+class Bundle(object):
+    """Files packed into a single compressed tar stream (to send at once).
+
+    Sending a bundle unpacks it (on a server) through a single exec (its
+    tar stream is piped into that exec's stdin) instead of doing an sftp
+    operation (and maybe running a command) per file.
+    """
+
+    def __init__(self):
+        self.files = []
+        # Packing (and hashing) is only done once (until files change).
+        self._packed = None
+        self._digests = {}
+
+    def __len__(self):
+        return len(self.files)
+
+    def add(self, name, local_path=None, contents=None, mode=None):
+        """Adds a file (from a local path or from contents) to the bundle."""
+        if (local_path is None) == (contents is None):
+            raise ValueError("One of a local path or contents must be"
+                             " provided (and not both)")
+        if isinstance(contents, six.text_type):
+            contents = contents.encode("utf8")
+        self.files.append((name, local_path, contents, mode))
+        self._packed = None
+        self._digests.clear()
+
+    def add_dir(self, local_dir, suffix=''):
+        """Adds the files in a local directory (that end with a suffix)."""
+        for file_name in sorted(os.listdir(local_dir)):
+            local_path = os.path.join(local_dir, file_name)
+            if file_name.endswith(suffix) and os.path.isfile(local_path):
+                self.add(file_name, local_path=local_path)
+
+    def _read(self, local_path, contents):
+        if local_path is not None:
+            with open(local_path, 'rb') as fh:
+                contents = fh.read()
+        return contents
+
+    def digests(self, target_dir):
+        """Returns the sha256 of each file (by where it would be sent to)."""
+        digests = self._digests.get(target_dir)
+        if digests is None:
+            digests = collections.OrderedDict()
+            for name, local_path, contents, _mode in self.files:
+                contents = self._read(local_path, contents)
+                digests[posixpath.join(target_dir, name)] = (
+                    hashlib.sha256(contents).hexdigest())
+            self._digests[target_dir] = digests
+        return digests.copy()
+
+    def without(self, target_dir, paths):
+        """Returns a bundle without the files (that would be sent to) paths."""
+        paths = frozenset(paths)
+        bundle = Bundle()
+        for name, local_path, contents, mode in self.files:
+            if posixpath.join(target_dir, name) not in paths:
+                bundle.add(name, local_path=local_path,
+                           contents=contents, mode=mode)
+        return bundle
+
+    def pack(self):
+        """Returns the (gzipped) tar stream of all the files."""
+        if self._packed is not None:
+            return self._packed
+        buf = io.BytesIO()
+        tar = tarfile.open(fileobj=buf, mode='w:gz')
+        try:
+            for name, local_path, contents, mode in self.files:
+                if local_path is not None:
+                    info = tar.gettarinfo(local_path, arcname=name)
+                    contents = self._read(local_path, contents)
+                else:
+                    info = tarfile.TarInfo(name)
+                    info.mtime = time.time()
+                    info.mode = 0o644
+                info.size = len(contents)
+                if mode is not None:
+                    info.mode = mode
+                # Owned by whoever unpacks it (or by root when that is
+                # done as root).
+                info.uid = info.gid = 0
+                info.uname = info.gname = "root"
+                tar.addfile(info, io.BytesIO(contents))
+        finally:
+            tar.close()
+        self._packed = buf.getvalue()
+        return self._packed
+
+    def send(self, machine, target_dir, sudo=False, after=None):
+        """Unpacks the bundle into a directory on a machine.
+
+        If given, the ``after`` shell snippet is ran (in the directory,
+        and as part of the same exec) once the bundle is unpacked.
+        """
+        cmd = _sh(machine, sudo=sudo)
+        proc = cmd.popen(['-c', _unpack_command("-", target_dir, after)])
+        stdout, stderr = utils.feed_process(proc, self.pack())
+        if proc.returncode != 0:
+            raise utils.RemoteExecutionFailed(
+                "Unpacking %s file/s into %s on %s failed with exit"
+                " code %s: %s" % (len(self.files), target_dir,
+                                  getattr(machine, 'host', machine),
+                                  proc.returncode,
+                                  utils.trim_it(_to_text(stderr or stdout),
+                                                1024, reverse=True)))
+        return stdout
+
+
+def unpack(machine, archive_path, target_dir, sudo=False, after=None):
+    """Unpacks a bundle already on a machine (see :py:func:`.broadcast`)."""
+    exit_code, stdout, stderr = _sh(machine, sudo=sudo).run(
+        ['-c', _unpack_command(archive_path, target_dir, after)],
+        retcode=None)
+    if exit_code != 0:
+        raise utils.RemoteExecutionFailed(
+            "Unpacking %s into %s on %s failed with exit code %s: %s" % (
+                archive_path, target_dir, getattr(machine, 'host', machine),
+                exit_code, utils.trim_it(_to_text(stderr or stdout),
+                                         1024, reverse=True)))
+    return stdout
+
+
+def broadcast(machines, seed, targets, bundles, stage_dir, fanout=2,
+              indent='', verbose=False):
+    """Sends bundles to many servers (each server relaying them on).
+
+    The bundles are only sent (from here) to the seed server, after that
+    (in rounds) each server that has them sends them (over ssh, from its
+    stage directory to the same directory on the other server) to up to
+    ``fanout`` servers that do not have them yet; so the number of rounds
+    needed grows with the log (not the number) of servers. Each bundle
+    (by name) ends up in the stage directory as ``<name>.tgz``.
+    """
+    outer = Bundle()
+    for name, bundle in sorted(six.iteritems(bundles)):
+        outer.add("%s.tgz" % name, contents=bundle.pack())
+    outer.send(machines[seed.name], stage_dir)
+    holders = [seed]
+    pending = [server for server in targets if server is not seed]
+    failures = []
+    rounds = 0
+    while pending:
+        rounds += 1
+        relays = []
+        for holder in holders:
+            for _i in six.moves.range(fanout):
+                if not pending:
+                    break
+                relays.append((holder, pending.pop(0)))
+        if verbose:
+            print("%sRelay round %s: %s server/s sending to %s server/s" % (
+                indent, rounds, len(holders), len(relays)))
+        with futurist.ThreadPoolExecutor(max_workers=len(relays)) as ex:
+            futs = [(holder, target,
+                     ex.submit(_relay, machines[holder.name], target,
+                               stage_dir))
+                    for holder, target in relays]
+        for holder, target, fut in futs:
+            exc = fut.exception()
+            if exc is not None:
+                failures.append("%s => %s: %s" % (holder.name,
+                                                  target.name, exc))
+            else:
+                holders.append(target)
+    if failures:
+        raise utils.RemoteExecutionFailed(
+            "Relaying to %s server/s failed:\n%s" % (len(failures),
+                                                     "\n".join(failures)))
+    return rounds
+
+
+def _relay(machine, target, stage_dir):
+    quoted_dir = six.moves.shlex_quote(stage_dir)
+    remote_command = "mkdir -p %s && tar -xf - -C %s" % (quoted_dir,
+                                                         quoted_dir)
+    command = ("tar -cf - -C %s . | ssh -o BatchMode=yes"
+               " -o StrictHostKeyChecking=no %s %s" % (
+                   quoted_dir, six.moves.shlex_quote(target.ip),
+                   six.moves.shlex_quote(remote_command)))
+    exit_code, stdout, stderr = machine['sh'].run(['-c', command],
+                                                  retcode=None)
+    if exit_code != 0:
+        raise utils.RemoteExecutionFailed(
+            "Exit code %s: %s" % (exit_code,
+                                  utils.trim_it(_to_text(stderr or stdout),
+                                                1024, reverse=True)))
+
+
+def remote_digests(machine, paths):
+    """Returns the sha256 of files on a machine (with a single exec).
+
+    Files that do not exist (or can not be read) are left out.
+    """
+    _exit_code, stdout, _stderr = machine['sha256sum'].run(list(paths),
+                                                           retcode=None)
+    digests = {}
+    for line in _to_text(stdout).splitlines():
+        pieces = line.split(None, 1)
+        if len(pieces) == 2:
+            digests[pieces[1]] = pieces[0]
+    return digests
+
+
+def _sh(machine, sudo=False):
+    cmd = machine['sh']
+    if sudo:
+        cmd = machine['sudo'][cmd]
+    return cmd
+
+
+def _unpack_command(source, target_dir, after=None):
+    quoted_dir = six.moves.shlex_quote(target_dir)
+    command = "mkdir -p %s && tar -xzf %s -C %s" % (
+        quoted_dir, six.moves.shlex_quote(source), quoted_dir)
+    if after:
+        command += " && cd %s && { %s\n}" % (quoted_dir, after)
+    return command
+
+
+def _to_text(data):
+    if isinstance(data, six.binary_type):
+        return data.decode("utf8", "replace")
+    return data
@@ -5,6 +5,7 @@ from __future__ import print_function
 from binascii import hexlify
 
 import collections
+import contextlib
 import errno
 import functools
 import itertools
@@ -29,20 +30,92 @@ from paramiko.common import DEBUG
 from plumbum.machines.paramiko_machine import ParamikoMachine as SshMachine
 
 import builder as bu
+from builder import prober
 
 PASS_CHARS = string.ascii_lowercase + string.digits
 
 
+class LazyMachines(collections.Mapping):
+    """Machines (of a helper's servers) that are connected to on first use.
+
+    Looking up a server's machine connects to it (with the given
+    connector, which is called with the server) if not yet connected,
+    or if its prior connection has dropped (since then). Iterating only
+    goes over the machines that are currently connected.
+    """
+
+    def __init__(self, helper, connector=None):
+        self._helper = helper
+        self._connector = connector
+        self._machines = {}
+        self._locks = collections.defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def _get_lock(self, server_name):
+        with self._lock:
+            return self._locks[server_name]
+
+    def __getitem__(self, server_name):
+        with self._get_lock(server_name):
+            machine = self._machines.get(server_name)
+            if machine is not None:
+                if machine_alive(machine):
+                    return machine
+                print("Connection to %s dropped, reconnecting." % server_name)
+                self._discard(server_name)
+            server = self._helper.find_server(server_name)
+            if server is None or self._connector is None:
+                raise KeyError(server_name)
+            machine = self._connector(server)
+            self._machines[server_name] = machine
+            return machine
+
+    def __iter__(self):
+        return iter(list(self._machines))
+
+    def __len__(self):
+        return len(self._machines)
+
+    def dropped(self, server_name):
+        """Returns if a server was connected to but no longer is."""
+        machine = self._machines.get(server_name)
+        return machine is not None and not machine_alive(machine)
+
+    def _discard(self, server_name):
+        machine = self._machines.pop(server_name, None)
+        if machine is not None:
+            try:
+                machine.close()
+            except Exception:
+                pass
+
+    def close(self):
+        for server_name in list(self._machines):
+            self._discard(server_name)
+
+
+def machine_alive(machine):
+    """Returns if a machine (its connection) is still usable."""
+    is_alive = getattr(machine, 'is_alive', None)
+    if is_alive is None:
+        return True
+    return is_alive()
+
+
 class BuildHelper(object):
     """Conglomerate of util. things for our to-be/in-progress cloud."""
 
-    def __init__(self, cloud, tracker, topo):
+    def __init__(self, cloud, tracker, topo, recorder=None, connector=None):
         self.topo = topo
-        self.machines = {}
         self.tracker = tracker
+        if recorder is None:
+            recorder = Recorder(tracker)
+        self.recorder = recorder
         self.cloud = cloud
         self._settings = None
         self._exit_stack = contextlib2.ExitStack()
+        self.machines = LazyMachines(self, connector=connector)
+        self._exit_stack.callback(self.machines.close)
 
     def iter_servers(self):
         compute_servers = self.topo['compute']
@@ -54,35 +127,46 @@ class BuildHelper(object):
     def server_count(self):
         return len(list(self.iter_servers()))
 
-    def maybe_run(self, pre_state, post_state,
-                  func, func_on_done=None, indent='',
-                  func_name=None, func_details=''):
-        if not func_details:
-            func_details = getattr(func, '__doc__', '')
-        if not func_name:
-            func_name = reflection.get_callable_name(func)
-        print("%sActivating function '%s'" % (indent, func_name))
-        if func_details:
-            print("%sDetails: '%s'" % (indent, func_details))
-        applicable_servers = []
-        for server in self.iter_servers():
-            if server.builder_state < post_state:
-                applicable_servers.append(server)
-        last_result = None
-        for server in applicable_servers:
-            server.builder_state = pre_state
-            self.save_topo()
-            last_result = func(self, server,
-                               last_result=last_result,
-                               indent=indent + "  ")
-            server.builder_state = post_state
-            self.save_topo()
-        if func_on_done is not None and applicable_servers:
-            func_on_done(self, indent=indent + "  ")
-        print("%sFunction '%s' has finished." % (indent, func_name))
+    def run_on_server(self, server, pre_state, post_state, func,
+                      last_result=None, indent='', name=None, retries=0):
+        """Runs a function on a server (recording its state transitions).
+
+        If the function fails because the connection to the server
+        dropped (and it is safe to run again) it is retried (up to the
+        given number of times) over a new connection.
+        """
+        if not name:
+            name = reflection.get_callable_name(func)
+        self.set_server_state(server, pre_state)
+        while True:
+            try:
+                with self.recorder.time_server(server, name):
+                    result = func(self, server, last_result=last_result,
+                                  indent=indent)
+            except Exception as e:
+                if retries <= 0 or not self.machines.dropped(server.name):
+                    raise
+                retries -= 1
+                print("%sRunning '%s' on %s failed (its connection"
+                      " dropped), retrying: %s" % (indent, name,
+                                                   server.name, e))
+            else:
+                break
+        self.set_server_state(server, post_state)
+        return result
+
+    def set_server_state(self, server, state):
+        with self.tracker.lock:
+            server.builder_state = state
+        self.save_server(server)
+
+    def save_server(self, server):
+        self.tracker.mark_server(server)
+        self.tracker.sync()
 
     def save_topo(self):
-        self.tracker['topo'] = self.topo
+        with self.tracker.lock:
+            self.tracker['topo'] = self.topo
         self.tracker.sync()
 
     @property
@@ -90,15 +174,16 @@ class BuildHelper(object):
         if self._settings is not None:
             return self._settings
         else:
-            settings = self.tracker.get("settings", {})
-            for setting_name in bu.DEF_SETTINGS.keys():
-                if setting_name not in settings:
-                    settings[setting_name] = bu.DEF_SETTINGS[setting_name]
-            for setting_name in ['ADMIN_PASSWORD', 'SERVICE_TOKEN',
-                                 'SERVICE_PASSWORD', 'RABBIT_PASSWORD']:
-                if setting_name not in settings:
-                    settings[setting_name] = generate_secret()
-            self.tracker['settings'] = settings
+            with self.tracker.lock:
+                settings = self.tracker.get("settings", {})
+                for setting_name in bu.DEF_SETTINGS.keys():
+                    if setting_name not in settings:
+                        settings[setting_name] = bu.DEF_SETTINGS[setting_name]
+                for setting_name in ['ADMIN_PASSWORD', 'SERVICE_TOKEN',
+                                     'SERVICE_PASSWORD', 'RABBIT_PASSWORD']:
+                    if setting_name not in settings:
+                        settings[setting_name] = generate_secret()
+                self.tracker['settings'] = settings
             self.tracker.sync()
             self._settings = settings
             return self._settings
@@ -111,31 +196,54 @@ class BuildHelper(object):
     def __enter__(self):
         return self
 
-    def bind_machine(self, server_name, machine):
-        matched_servers = [server for server in self.iter_servers()
-                           if server.name == server_name]
-        if not matched_servers:
-            raise RuntimeError("Can not match ssh machine"
-                               " to unknown server '%s'" % server_name)
-        self.machines[server_name] = machine
-        self._exit_stack.callback(machine.close)
+    def find_server(self, server_name):
+        for server in self.iter_servers():
+            if server.name == server_name:
+                return server
+        return None
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._exit_stack.close()
 
 
 class Tracker(collections.MutableMapping):
-    """Tracker that tracks data about a single cloud."""
+    """Tracker that tracks data about a single cloud.
+
+    When created with a positive delay syncs are write-behind, a background
+    writer saves (at most) once per delay window no matter how many syncs
+    were requested in that window; ``flush`` saves immediately. Anything
+    that mutates tracked data while other threads may be syncing should
+    hold the trackers ``lock`` while doing so.
+
+    Saves only save what was marked as changed (setting or deleting a key
+    marks it), so anything that mutates tracked data in place must also
+    mark what it changed (the key, or the topology server) before syncing;
+    the first save (and the one done on close) saves everything.
+    """
 
-    def __init__(self, data, saver):
+    def __init__(self, data, saver, delay=0.0):
         self._data = data
         self._saver = saver
+        self.delay = delay
+        self.lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._dead = threading.Event()
+        self._writer = None
+        self._failure = None
+        self._changed_keys = set()
+        self._changed_servers = {}
+        self._changed_all = True
 
     def __setitem__(self, key, value):
-        self._data[key] = value
+        with self.lock:
+            self._data[key] = value
+            self._changed_keys.add(key)
 
     def __delitem__(self, key):
-        del self._data[key]
+        with self.lock:
+            del self._data[key]
+            self._changed_keys.add(key)
 
     def __len__(self):
         return len(self._data)
@@ -146,8 +254,151 @@ class Tracker(collections.MutableMapping):
     def __getitem__(self, key):
         return self._data[key]
 
+    def _check_failure(self):
+        failure, self._failure = self._failure, None
+        if failure is not None:
+            six.reraise(*failure)
+
+    def mark(self, key):
+        """Marks a (top-level) key as changed (in place)."""
+        with self.lock:
+            self._changed_keys.add(key)
+
+    def mark_server(self, server):
+        """Marks a (topology) server as changed (in place)."""
+        with self.lock:
+            self._changed_servers[id(server)] = server
+
+    def _save(self, full=False):
+        # Saves happen one at a time (so that they land in order) but the
+        # lock is only held while snapshotting (not while writing).
+        with self._save_lock:
+            with self.lock:
+                self._dirty.clear()
+                if full or self._changed_all:
+                    changes = None
+                else:
+                    changes = (frozenset(self._changed_keys),
+                               list(self._changed_servers.values()))
+                self._changed_keys.clear()
+                self._changed_servers.clear()
+                self._changed_all = False
+                try:
+                    writer = self._saver(changes)
+                except Exception:
+                    # What was not saved is unknown now, so save it all
+                    # next time.
+                    self._changed_all = True
+                    raise
+            if writer is not None:
+                try:
+                    writer()
+                except Exception:
+                    with self.lock:
+                        self._changed_all = True
+                    raise
+
+    def _run_writer(self):
+        while not self._dead.is_set():
+            self._dirty.wait()
+            # Give others a chance to mark us dirty again (so that those
+            # requests can be coalesced into a single save).
+            self._dead.wait(self.delay)
+            try:
+                self._save()
+            except Exception:
+                self._failure = sys.exc_info()
+
     def sync(self):
-        self._saver()
+        self._check_failure()
+        if self.delay <= 0:
+            self._save()
+        else:
+            with self.lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run_writer)
+                    self._writer.daemon = True
+                    self._writer.start()
+            self._dirty.set()
+
+    def flush(self):
+        self._check_failure()
+        self._save()
+
+    def close(self):
+        if self._writer is not None:
+            self._dead.set()
+            self._dirty.set()
+            self._writer.join()
+            self._writer = None
+        self._check_failure()
+        self._save(full=True)
+
+
+class Recorder(object):
+    """Records when things (for each server and for the cluster) ran.
+
+    Times are (monotonic) seconds since this recorder was created, kept
+    along with when (wall clock) that was so that times from the last
+    run can be told apart from times recorded by prior runs. The clock
+    used can be swapped out (it must be monotonic).
+    """
+
+    def __init__(self, tracker, clock=now):
+        self.tracker = tracker
+        self.clock = clock
+        self._started_at = clock()
+        self.run_id = time.time()
+        with tracker.lock:
+            tracker['timings'] = {'run_id': self.run_id, 'steps': {}}
+
+    def elapsed(self):
+        return self.clock() - self._started_at
+
+    @contextlib.contextmanager
+    def time_server(self, server, name):
+        """Records (into the server) how long something on it took."""
+        start = self.elapsed()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            end = self.elapsed()
+            with self.tracker.lock:
+                if server.timings is None:
+                    server.timings = {}
+                server.timings[name] = (self.run_id, start, end, ok)
+            self.tracker.mark_server(server)
+            self.tracker.sync()
+
+    def record_graph(self, stages, steps):
+        """Records what stages (and cluster steps) wait on (for reports)."""
+        with self.tracker.lock:
+            graph = self.tracker['timings'].setdefault(
+                'graph', {'stages': {}, 'steps': {}})
+            for stage in stages:
+                graph['stages'][stage.name] = sorted(stage.requires)
+            for step in steps:
+                graph['steps'][step.name] = step.after
+            self.tracker.mark('timings')
+        self.tracker.sync()
+
+    @contextlib.contextmanager
+    def time_step(self, name):
+        """Records how long some cluster (not single server) step took."""
+        start = self.elapsed()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            end = self.elapsed()
+            with self.tracker.lock:
+                timings = self.tracker['timings']
+                timings['steps'][name] = (self.run_id, start, end, ok)
+            self.tracker.mark('timings')
+            self.tracker.sync()
 
 
 class Spinner(object):
@@ -158,6 +409,9 @@ class Spinner(object):
         u"◳◲◱◰",
     ])
 
+    #: Only one spinner may animate at a time (others just print).
+    _animating = threading.Lock()
+
     def __init__(self, message, verbose, delay=0.3):
         self.verbose = verbose
         self.message = message
@@ -186,10 +440,12 @@ class Spinner(object):
         if output or message_sent:
             sys.stdout.write("\n")
             sys.stdout.flush()
+        self._animating.release()
         self._dead.set()
 
     def start(self):
-        if not self.verbose and sys.stdout.isatty():
+        if (not self.verbose and sys.stdout.isatty() and
+                self._animating.acquire(False)):
             self._dead.clear()
             self._ev.clear()
             self._t = threading.Thread(target=self._runner)
@@ -218,6 +474,10 @@ class RemoteExecutionFailed(Exception):
     pass
 
 
+class StageFailed(Exception):
+    pass
+
+
 class RemoteCommand(object):
     def __init__(self, cmd, *cmd_args, **kwargs):
         self.cmd = cmd
@@ -225,6 +485,10 @@ class RemoteCommand(object):
         self.server = kwargs.get('server')
         self.scratch_dir = kwargs.get('scratch_dir')
         self.name = " ".join(cmd.formulate())
+        # The command that really runs (not whatever runs it, like sudo).
+        cmd_parts = [part for part in cmd.formulate()
+                     if os.path.basename(part) != 'sudo']
+        self.short_name = os.path.basename(cmd_parts[0])
         self.full_name = self.name
         if cmd_args:
             self.full_name += " "
@@ -277,6 +541,19 @@ def get_server_ip(server):
     return None
 
 
+def feed_process(proc, data):
+    """Sends data to (the stdin of) a process returning its output."""
+    channel = getattr(proc, 'channel', None)
+    if channel is None:
+        return proc.communicate(data)
+    # Remote (paramiko) processes do not take input with communicate,
+    # and only see the end of their input once the channel says so.
+    proc.stdin.write(data)
+    proc.stdin.flush()
+    channel.shutdown_write()
+    return proc.communicate()
+
+
 def trim_it(block, max_len, reverse=False):
     block_len = len(block)
     if not reverse:
@@ -295,8 +572,16 @@ def trim_it(block, max_len, reverse=False):
 def run_and_record(remote_cmds, indent="",
                    err_chop_len=1024, max_workers=None,
                    verbose=True, on_done=None,
-                   on_start=None):
+                   on_start=None, recorder=None):
     def cmd_runner(remote_cmd, index, stdout_fh, stderr_fh):
+        if recorder is not None and remote_cmd.server is not None:
+            with recorder.time_server(remote_cmd.server,
+                                      remote_cmd.short_name):
+                return _cmd_runner(remote_cmd, index, stdout_fh, stderr_fh)
+        else:
+            return _cmd_runner(remote_cmd, index, stdout_fh, stderr_fh)
+
+    def _cmd_runner(remote_cmd, index, stdout_fh, stderr_fh):
         if on_start is not None:
             on_start(remote_cmd, index)
         header_msg = "Running `%s`" % remote_cmd.full_name
@@ -379,6 +664,123 @@ class IgnoreMissingHostKeyPolicy(paramiko.MissingHostKeyPolicy):
                     (key.get_name(), hostname, hexlify(key.get_fingerprint())))
 
 
+class _ChannelPool(object):
+    """Pool of (lazily opened) things that each use a channel of a transport.
+
+    Hands each user a free one (opening more, up to a limit, when all are
+    in use, otherwise waiting for one to be released).
+    """
+
+    def __init__(self, opener, max_size, initial=()):
+        self._opener = opener
+        self._max_size = max(1, max_size)
+        self._cond = threading.Condition()
+        self._free = list(initial)
+        self._all = list(initial)
+
+    @contextlib.contextmanager
+    def checkout(self):
+        with self._cond:
+            while not self._free and len(self._all) >= self._max_size:
+                self._cond.wait()
+            if self._free:
+                thing = self._free.pop()
+            else:
+                # Reserve the slot (opening may take a little while).
+                self._all.append(None)
+                thing = None
+        if thing is None:
+            try:
+                thing = self._opener()
+            except Exception:
+                with self._cond:
+                    self._all.remove(None)
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._all[self._all.index(None)] = thing
+        try:
+            yield thing
+        finally:
+            with self._cond:
+                self._free.append(thing)
+                self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            things, self._all, self._free = self._all, [], []
+        for thing in things:
+            if thing is not None:
+                thing.close()
+
+
+class _SessionPool(object):
+    """Stands in for the single shell session plumbum runs path ops with."""
+
+    def __init__(self, machine, max_size):
+        self._pool = _ChannelPool(machine.session, max_size,
+                                  initial=[machine._session])
+
+    def run(self, *args, **kwargs):
+        with self._pool.checkout() as session:
+            return session.run(*args, **kwargs)
+
+    def alive(self):
+        return True
+
+    def close(self):
+        self._pool.close()
+
+
+class MultiplexedSshMachine(SshMachine):
+    """Ssh machine that can do many things (on its host) at once.
+
+    Everything happens over the one (authenticated) transport this
+    machine has; commands already get their own channel each, but the
+    shell session plumbum does file/path operations (and program
+    lookups) through and the sftp client uploads go through are single
+    channels that serialize their users, those are replaced with small
+    pools of channels (over that same transport). Note that sshd caps
+    channels per connection (its ``MaxSessions``, typically ten).
+    """
+
+    def __init__(self, *args, **kwargs):
+        max_sessions = kwargs.pop('max_sessions', 3)
+        max_sftps = kwargs.pop('max_sftps', 2)
+        keepalive = kwargs.pop('keepalive', 30)
+        SshMachine.__init__(self, *args, **kwargs)
+        # Idle connections (while waiting on other servers) otherwise
+        # get dropped by firewalls/nat gateways in between.
+        if keepalive:
+            self._client.get_transport().set_keepalive(keepalive)
+        self._session = _SessionPool(self, max_sessions)
+        self._sftps = _ChannelPool(self._client.open_sftp, max_sftps)
+        self._local = threading.local()
+
+    def is_alive(self):
+        transport = self._client.get_transport()
+        return transport is not None and transport.is_active()
+
+    @property
+    def sftp(self):
+        sftp = getattr(self._local, 'sftp', None)
+        if sftp is None:
+            sftp = super(MultiplexedSshMachine, self).sftp
+        return sftp
+
+    def upload(self, src, dst):
+        with self._sftps.checkout() as sftp:
+            self._local.sftp = sftp
+            try:
+                return super(MultiplexedSshMachine, self).upload(src, dst)
+            finally:
+                self._local.sftp = None
+
+    def close(self):
+        self._sftps.close()
+        super(MultiplexedSshMachine, self).close()
+
+
 def generate_secret(max_len=10):
     return "".join(random.choice(PASS_CHARS) for _i in xrange(0, max_len))
 
@@ -395,9 +797,9 @@ def safe_make_dir(a_dir):
 
 
 def ssh_connect(ip, connect_timeout=1.0,
-                max_backoff=60, max_attempts=12, indent="",
+                max_backoff=8, max_attempts=12, indent="",
                 user=None, password=None,
-                server_name=None, verbose=False):
+                server_name=None, verbose=False, ready_timeout=600):
     if server_name:
         display_name = server_name + " via " + ip
     else:
@@ -406,19 +808,30 @@ def ssh_connect(ip, connect_timeout=1.0,
     connected = False
     machine = None
     started_at = now()
+    # Cheaply wait for sshd to be up (and talking) before trying to
+    # really connect (and authenticate), which is far more costly.
+    if not prober.PROBER.wait(ip, timeout=ready_timeout):
+        raise IOError("Could not connect (over ssh) to %s, no ssh banner"
+                      " seen after %s seconds" % (display_name,
+                                                  ready_timeout))
+    if verbose:
+        print("%sSsh on %s is ready (took %0.2f seconds)" % (
+            indent, display_name, now() - started_at))
     while not connected:
         try:
-            machine = SshMachine(
+            machine = MultiplexedSshMachine(
                 ip, connect_timeout=connect_timeout,
                 missing_host_policy=IgnoreMissingHostKeyPolicy(),
                 user=user, password=password)
         except (plumbum.machines.session.SSHCommsChannel2Error,
                 plumbum.machines.session.SSHCommsError, socket.error,
-                paramiko.ssh_exception.AuthenticationException) as e:
+                paramiko.ssh_exception.SSHException) as e:
             if verbose:
                 print("%sFailed to connect to %s: %s" % (indent,
                                                          display_name, e))
-            backoff = min(max_backoff, 2 ** attempt)
+            # Jittered (so that many connecting at once spread out).
+            backoff = min(max_backoff, 0.5 * 2 ** attempt)
+            backoff = random.uniform(backoff / 2.0, backoff)
             attempt += 1
             if attempt > max_attempts:
                 raise IOError("Could not connect (over ssh) to"
@@ -427,10 +840,8 @@ def ssh_connect(ip, connect_timeout=1.0,
             more_attempts = max_attempts - attempt
             if verbose:
                 print("%sTrying connect to %s again in"
-                      " %s seconds (%s attempts left)..." % (indent,
-                                                             display_name,
-                                                             backoff,
-                                                             more_attempts))
+                      " %0.2f seconds (%s attempts left)..." % (
+                          indent, display_name, backoff, more_attempts))
             time.sleep(backoff)
         else:
             ended_at = now()
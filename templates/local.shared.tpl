@@ -25,6 +25,9 @@ LOG_COLOR=False
 ENABLE_DEBUG_LOG_LEVEL=true
 
 GIT_BASE=${GIT_BASE:-https://git.openstack.org}
+{% for repo_var, repo_url in GIT_REPO_URLS -%}
+{{ repo_var }}_REPO={{ repo_url }}
+{% endfor -%}
 SYSLOG=False
 USE_SCREEN=False
 LOG_COLOR=False
@@ -0,0 +1,414 @@
+from __future__ import print_function
+
+import argparse
+import contextlib
+import copy
+import functools
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+
+if os.path.exists(os.path.join(possible_topdir,
+                               'builder',
+                               '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from plumbum import local
+import six
+
+import builder
+from builder import creator
+from builder import pprint
+from builder import servers as sv
+from builder import states as st
+from builder import storage
+from builder import transfer
+from builder import utils
+
+from builder.roles import Roles
+
+
+def make_topo(size):
+    """Makes a (filled in) topology with (about) size servers."""
+    topo = copy.deepcopy(builder.DEF_TOPO)
+    for i in six.moves.range(size):
+        topo['compute'].append(sv.Server(
+            "hv-%s" % i, Roles.HV, builder_state=st.STACK_SH_END,
+            filled=True, id="%032x" % i, image_id="image-%s" % i,
+            flavor_id=builder.DEF_FLAVORS[Roles.HV],
+            availability_zone="az-%s" % (i % 3), status='ACTIVE',
+            ip="10.0.%s.%s" % (i // 250, i % 250 + 1),
+            hostname="hv-%s.example.com" % i,
+            timings={'stack.sh': (0.0, float(i), float(i) + 600.0, True)}))
+    for r in Roles:
+        if r != Roles.HV:
+            topo['control'][r] = sv.Server("%s-1" % r.name.lower(), r)
+    return topo
+
+
+def make_lines(megabytes, line_len=120):
+    line = "x" * (line_len - 1)
+    for _i in six.moves.range((megabytes * 1024 * 1024) // line_len):
+        yield line
+
+
+class _Process(object):
+    def __init__(self, megabytes):
+        self.megabytes = megabytes
+
+    def iter_lines(self):
+        for line in make_lines(self.megabytes):
+            yield (line, None)
+
+
+class _Machine(object):
+    host = 'bench'
+
+
+class _Command(object):
+    """Command (for run_and_record) that outputs a lot of lines."""
+
+    machine = _Machine()
+
+    def __init__(self, megabytes):
+        self.megabytes = megabytes
+
+    def formulate(self):
+        return ['bench.sh']
+
+    def popen(self, args=()):
+        return _Process(self.megabytes)
+
+
+class _Cloud(object):
+    auth = {'username': 'bench', 'project_name': 'bench'}
+
+
+class _Tracker(dict):
+    def __init__(self):
+        super(_Tracker, self).__init__()
+        self.lock = threading.RLock()
+
+    def sync(self):
+        pass
+
+
+@contextlib.contextmanager
+def quiet():
+    old_stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = old_stdout
+
+
+class Timed(float):
+    """Seconds (only part of what a benchmark did) took."""
+
+
+def max_rss():
+    """Returns the peak resident memory (in bytes) of this process."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        # Linux (and most others) report it in kilobytes.
+        peak *= 1024
+    return peak
+
+
+def measure(func, repeat):
+    """Runs a function (repeatedly) returning best time and peak memory.
+
+    Functions that only want part of what they do timed (and not their
+    setup) return how long that part took (as :py:class:`.Timed`).
+    Without tracemalloc (on older pythons) the peak memory is the peak
+    of this whole process so far.
+    """
+    best = None
+    peak = None
+    for _i in six.moves.range(repeat):
+        gc.collect()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        started_at = utils.now()
+        try:
+            result = func()
+        finally:
+            if tracemalloc is not None:
+                _current, run_peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            else:
+                run_peak = max_rss()
+            if run_peak is not None:
+                peak = max(peak or 0, run_peak)
+        if isinstance(result, Timed):
+            elapsed = result
+        else:
+            elapsed = utils.now() - started_at
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, peak
+
+
+def bench_savers(size, tmp_dir):
+    """Saving a topology (fully, and syncing a single server changing)."""
+    benches = []
+    for kind in sorted(storage.STORES.keys()):
+        path = os.path.join(tmp_dir, "%s-%s.%s" % (
+            kind, size, storage.STORE_EXTENSIONS[kind]))
+
+        def run(path=path, kind=kind, sync=False):
+            store = storage.open_store(path, kind=kind)
+            try:
+                clouds = store.load()
+                cloud = clouds.setdefault('bench', {})
+                cloud['topo'] = make_topo(size)
+                tracker = utils.Tracker(cloud,
+                                        store.make_saver('bench', cloud))
+                started_at = utils.now()
+                tracker.flush()
+                if not sync:
+                    return Timed(utils.now() - started_at)
+                # Like what happens (over and over) as servers go through
+                # their stages.
+                server = cloud['topo']['compute'][0]
+                started_at = utils.now()
+                with tracker.lock:
+                    server.builder_state = st.NO_STATE
+                tracker.mark_server(server)
+                tracker.sync()
+                return Timed(utils.now() - started_at)
+            finally:
+                store.close()
+                for suffix in ['', '.log', '.log.compacting', '.lock',
+                               '.compact.lock', '-wal', '-shm']:
+                    if os.path.exists(path + suffix):
+                        os.unlink(path + suffix)
+
+        benches.append(("save(%s)" % kind, run))
+        benches.append(("sync(%s)" % kind,
+                        functools.partial(run, sync=True)))
+    return benches
+
+
+def bench_pformat(size, tmp_dir):
+    """Pretty formatting a topology (like fill_topo does)."""
+    topo = make_topo(size)
+    pretty_topo = {}
+    for plane, servers in [('compute', topo['compute']),
+                           ('control', list(topo['control'].values()))]:
+        pretty_topo[plane] = {}
+        for server in servers:
+            pretty_topo[plane][server.name] = {
+                'name': server.name,
+                'flavor': server.flavor_id,
+                'image': server.image_id,
+                'availability_zone': server.availability_zone,
+                'kind': server.kind.name,
+            }
+    return [("pformat", lambda: pprint.pformat(pretty_topo))]
+
+
+def bench_create_topo(size, tmp_dir):
+    """Picking names for (and creating) a new topology."""
+    args = argparse.Namespace(new_topo=True, hypervisors=size)
+    # Some names are already taken (by servers that already exist).
+    curr_servers = dict(("hv-%s" % i, None)
+                        for i in six.moves.range(size // 10))
+
+    def run():
+        creator.create_topo(args, _Cloud(), _Tracker(), curr_servers)
+
+    return [("create_topo", run)]
+
+
+def bench_run_and_record(megabytes, tmp_dir):
+    """Recording (to files) the output of a command."""
+
+    def run():
+        cmd = utils.RemoteCommand(_Command(megabytes), scratch_dir=tmp_dir)
+        with quiet():
+            utils.run_and_record([cmd], verbose=True)
+        os.unlink(cmd.stdout_path)
+        os.unlink(cmd.stderr_path)
+
+    return [("run_and_record", run)]
+
+
+def bench_trim_it(megabytes, tmp_dir):
+    """Trimming (the start and the end of) command output."""
+    block = "\n".join(make_lines(megabytes))
+    return [
+        ("trim_it", lambda: utils.trim_it(block, 1024)),
+        ("trim_it(reverse)",
+         lambda: utils.trim_it(block, 1024, reverse=True)),
+    ]
+
+
+def bench_transfer(count, tmp_dir):
+    """Copying a directory of small files (exec per file or as a bundle).
+
+    Ran against the local machine, so this only shows what an exec per
+    file costs next to packing (and unpacking) a bundle; it does not
+    measure uploads, where each per-file sftp operation and exec is also
+    a network round trip.
+    """
+    src_dir = os.path.join(tmp_dir, "files-%s" % count)
+    os.mkdir(src_dir)
+    for i in six.moves.range(count):
+        with open(os.path.join(src_dir, "%s.sh" % i), 'w') as fh:
+            fh.write("# Extra %s\n" % i * 20)
+    dst_dir = os.path.join(tmp_dir, "dst-%s" % count)
+
+    def run_per_file():
+        os.mkdir(dst_dir)
+        try:
+            cp = local['cp']
+            for file_name in sorted(os.listdir(src_dir)):
+                cp(os.path.join(src_dir, file_name), dst_dir)
+        finally:
+            shutil.rmtree(dst_dir)
+
+    def run_bundle():
+        try:
+            bundle = transfer.Bundle()
+            bundle.add_dir(src_dir)
+            bundle.send(local, dst_dir)
+        finally:
+            shutil.rmtree(dst_dir)
+
+    return [("local_copy(exec-per-file)", run_per_file),
+            ("local_copy(bundle)", run_bundle)]
+
+
+TOPO_BENCHES = [bench_savers, bench_pformat, bench_create_topo]
+OUTPUT_BENCHES = [bench_run_and_record, bench_trim_it]
+FILE_BENCHES = [bench_transfer]
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                          cwd=possible_topdir,
+                                          stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return rev.decode("utf8").strip()
+
+
+def int_list(val):
+    try:
+        return [int(piece) for piece in val.split(",") if piece.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a comma separated"
+                                         " list of integers" % val)
+
+
+def format_bytes(amount):
+    if amount is None:
+        return "n/a"
+    return "%0.2fMiB" % (amount / (1024.0 * 1024.0))
+
+
+def compare(results, old_results):
+    old = dict(((r['name'], r['size']), r) for r in old_results['results'])
+    print("Compared to %s (%s):" % (old_results.get('revision'),
+                                    old_results.get('created_at')))
+    for r in results['results']:
+        o = old.get((r['name'], r['size']))
+        if o is None or not o.get('seconds') or r.get('seconds') is None:
+            continue
+        print("  %-26s %8s %9.2fx time %s -> %s peak" % (
+            r['name'], r['size'], r['seconds'] / o['seconds'],
+            format_bytes(o.get('peak_bytes')),
+            format_bytes(r.get('peak_bytes'))))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes",
+                        help="comma separated topology sizes (server"
+                             " counts) to benchmark (default=%(default)s)",
+                        type=int_list, default="10,100,500,2000")
+    parser.add_argument("--output-megabytes",
+                        help="comma separated command output sizes (in"
+                             " megabytes) to benchmark (default=%(default)s)",
+                        type=int_list, default="1,8")
+    parser.add_argument("--file-counts",
+                        help="comma separated counts of (small) files to"
+                             " benchmark copying (default=%(default)s)",
+                        type=int_list, default="10,100,500")
+    parser.add_argument("-r", "--repeat",
+                        help="times to run each benchmark (the best time"
+                             " is kept) (default=%(default)s)",
+                        type=int, default=3)
+    parser.add_argument("-o", "--output",
+                        help="file to save (json) results into",
+                        default=None, metavar="PATH")
+    parser.add_argument("-c", "--compare",
+                        help="file of (json) results (saved by a prior"
+                             " run) to compare against",
+                        default=None, metavar="PATH")
+    args = parser.parse_args()
+    results = {
+        'revision': git_revision(),
+        'created_at': time.time(),
+        'python': platform.python_version(),
+        'results': [],
+    }
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for benches, sizes in [(TOPO_BENCHES, args.sizes),
+                               (OUTPUT_BENCHES, args.output_megabytes),
+                               (FILE_BENCHES, args.file_counts)]:
+            for size in sizes:
+                for make_benches in benches:
+                    for name, func in make_benches(size, tmp_dir):
+                        result = {'name': name, 'size': size}
+                        try:
+                            seconds, peak = measure(func, args.repeat)
+                        except Exception as e:
+                            result['error'] = str(e)
+                            print("%-26s %8s failed: %s" % (name, size, e))
+                        else:
+                            result['seconds'] = seconds
+                            result['peak_bytes'] = peak
+                            print("%-26s %8s %10.4fs %12s peak" % (
+                                name, size, seconds, format_bytes(peak)))
+                        results['results'].append(result)
+    finally:
+        shutil.rmtree(tmp_dir)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r') as fh:
+            compare(results, json.load(fh))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,13 @@
 import argparse
-import pickle
+import fnmatch
+import json
 import pprint as pp
 import os
 import sys
 
+import enum
 import munch
+import six
 
 possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
                                    os.pardir,
@@ -15,28 +18,136 @@ if os.path.exists(os.path.join(possible_topdir,
                                '__init__.py')):
     sys.path.insert(0, possible_topdir)
 
+from builder import states as st
+from builder import storage
+
+from builder.roles import Roles
+
+
+def state_value(val):
+    """Converts a state name (or number) into a state number."""
+    try:
+        return int(val)
+    except ValueError:
+        try:
+            return getattr(st, val.upper())
+        except AttributeError:
+            msg = "%s is not a known state (or number)" % val
+            raise argparse.ArgumentTypeError(msg)
+
+
+def json_default(obj):
+    if isinstance(obj, enum.Enum):
+        return obj.name
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    return str(obj)
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--state",
                         help="file to read/write action state"
-                             " information into/from (default=%(default)s)",
-                        default=os.path.join(os.getcwd(), "state.pkl"),
-                        metavar="PATH")
+                             " information into/from (default=state.EXT in"
+                             " the current working directory, where EXT"
+                             " depends on the state format)",
+                        default=None, metavar="PATH")
+    parser.add_argument("--state-format",
+                        help="format used to persist action state"
+                             " information (default=%(default)s)",
+                        choices=sorted(storage.STORES.keys()),
+                        default='pickle')
     parser.add_argument("-c", "--cloud",
-                        help="cloud name to use",
+                        help="cloud name to use (if not provided all"
+                             " clouds are output, one at a time)",
                         default=None)
+    parser.add_argument("-r", "--role",
+                        help="only output servers with this role (may be"
+                             " specified more than once)",
+                        choices=[r.name for r in Roles],
+                        action='append', default=[])
+    parser.add_argument("-n", "--name",
+                        help="only output servers whose name matches this"
+                             " glob pattern (may be specified more"
+                             " than once)",
+                        action='append', default=[], metavar="PATTERN")
+    parser.add_argument("--min-state",
+                        help="only output servers whose builder state is"
+                             " at or above this state (name or number)",
+                        type=state_value, default=None, metavar="STATE")
+    parser.add_argument("--max-state",
+                        help="only output servers whose builder state is"
+                             " below this state (name or number)",
+                        type=state_value, default=None, metavar="STATE")
+    parser.add_argument("-o", "--output",
+                        help="output format, json outputs one"
+                             " line per server (default=%(default)s)",
+                        choices=['json', 'pprint'], default='json')
+    parser.add_argument("--raw",
+                        help="output all of the (unfiltered) cloud data"
+                             " instead of servers (this has to load the"
+                             " whole cloud into memory)",
+                        action='store_true', default=False)
     args = parser.parse_args()
-    with open(args.state, 'rb') as fh:
-        contents = fh.read()
-        if contents:
-            data = pickle.loads(contents)
-        else:
-            data = {}
-        if args.cloud:
-            data = data[args.cloud]
-        pp.pprint(data)
+    if not args.state:
+        args.state = os.path.join(
+            os.getcwd(),
+            "state.%s" % storage.STORE_EXTENSIONS[args.state_format])
+    store = storage.open_store(args.state, kind=args.state_format)
+    try:
+        return dump(args, store)
+    except IOError as e:
+        sys.stderr.write("Unable to read state from '%s': %s\n"
+                         % (args.state, e))
+        return 1
+
+
+def dump(args, store):
+    cloud_names = store.cloud_names()
+    if args.cloud:
+        if args.cloud not in cloud_names:
+            sys.stderr.write("No cloud named '%s' in '%s'\n"
+                             % (args.cloud, args.state))
+            return 1
+        cloud_names = [args.cloud]
+    if args.raw:
+        clouds = store.peek()
+        for cloud_name in cloud_names:
+            data = clouds[cloud_name]
+            if args.output == 'json':
+                print(json.dumps({'cloud': cloud_name, 'data': data},
+                                 default=json_default, sort_keys=True))
+            else:
+                pp.pprint({cloud_name: data})
+        return 0
+    kinds = [Roles[r] for r in args.role]
+    for cloud_name in cloud_names:
+        for server in store.iter_servers(cloud_name, kinds=kinds,
+                                         min_state=args.min_state,
+                                         max_state=args.max_state):
+            if args.name and not any(fnmatch.fnmatchcase(server.name, pat)
+                                     for pat in args.name):
+                continue
+            if hasattr(server, 'to_dict'):
+                server = server.to_dict()
+            else:
+                server = dict(six.iteritems(server))
+            for k, v in list(server.items()):
+                # Int enums would otherwise get output as plain numbers.
+                if isinstance(v, enum.Enum):
+                    server[k] = v.name
+            server['cloud'] = cloud_name
+            if args.output == 'json':
+                sys.stdout.write(json.dumps(server, default=json_default,
+                                            sort_keys=True))
+                sys.stdout.write("\n")
+                sys.stdout.flush()
+            else:
+                pp.pprint(server)
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,203 @@
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import os
+import sys
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+
+if os.path.exists(os.path.join(possible_topdir,
+                               'builder',
+                               '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+import builder
+from builder import storage
+
+# Things that end this close to (or after) something starting are
+# considered to be what it was waiting on.
+SLACK = 0.5
+
+# Name stack.sh runs are timed under (their order comes from what the
+# role of each server depends on).
+STACK_SH = 'stack.sh'
+
+Timing = collections.namedtuple('Timing',
+                                ['name', 'server', 'kind',
+                                 'start', 'end', 'ok'])
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def gather_timings(store, cloud_name, cloud):
+    """Gets the timings (of the last run) of the cluster and its servers."""
+    cloud_timings = cloud.get('timings') or {}
+    run_id = cloud_timings.get('run_id')
+    timings = []
+    for name, (t_run_id, start, end, ok) in sorted(
+            cloud_timings.get('steps', {}).items()):
+        if t_run_id == run_id:
+            timings.append(Timing(name, None, None, start, end, ok))
+    for server in store.iter_servers(cloud_name):
+        for name, (t_run_id, start, end, ok) in sorted(
+                (getattr(server, 'timings', None) or {}).items()):
+            if t_run_id == run_id:
+                timings.append(Timing(name, server.name, server.kind,
+                                      start, end, ok))
+    graph = cloud_timings.get('graph') or {'stages': {}, 'steps': {}}
+    return run_id, timings, graph
+
+
+def find_depends(timings, graph, curr):
+    """Finds the timings something (really) had to wait on.
+
+    Those are whatever ran before it on the same server (a server does
+    one thing at a time), the cluster steps a stage requires, the stage
+    (on all servers) a cluster step runs after, and the stack.sh runs
+    (of the roles it depends on) a stack.sh run waits on.
+    """
+    depends = []
+    if curr.server is not None:
+        depends.extend(t for t in timings
+                       if t.server == curr.server and t is not curr and
+                       t.start < curr.start)
+        for step_name in graph['stages'].get(curr.name, ()):
+            depends.extend(t for t in timings
+                           if t.server is None and t.name == step_name)
+        if curr.name == STACK_SH:
+            dep_kinds = builder.STACK_SH_DEPENDS.get(curr.kind, ())
+            depends.extend(t for t in timings
+                           if t.name == STACK_SH and t.kind in dep_kinds)
+    elif curr.name in graph['steps']:
+        after = graph['steps'][curr.name]
+        depends.extend(t for t in timings
+                       if t.server is not None and t.name == after)
+    return [t for t in depends if t.end <= curr.start + SLACK]
+
+
+def find_critical_path(timings, graph):
+    """Walks back from whatever ended last through what it waited on."""
+    if not timings:
+        return []
+    path = [max(timings, key=lambda t: t.end)]
+    while True:
+        # Of what it waited on, whatever ended last held it up.
+        depends = find_depends(timings, graph, path[-1])
+        if not depends:
+            break
+        path.append(max(depends, key=lambda t: t.end))
+    path.reverse()
+    return path
+
+
+def report(cloud_name, run_id, timings, graph, top=10, outlier_factor=2.0):
+    print("Cloud '%s'" % cloud_name)
+    if not timings:
+        print("  No timings recorded.")
+        return
+    started_at = datetime.datetime.fromtimestamp(run_id)
+    print("  Last run started at %s and took %0.2f seconds." % (
+        started_at.isoformat(), max(t.end for t in timings)))
+    by_name = collections.defaultdict(list)
+    for t in timings:
+        if t.server is not None:
+            by_name[t.name].append(t)
+    print("  Slowest (per server) stages:")
+    print("    %-24s %6s %9s %9s %9s %9s"
+          % ("Stage", "Count", "Min", "Median", "Max", "Total"))
+    stats = []
+    for name, name_timings in sorted(by_name.items()):
+        durations = [t.end - t.start for t in name_timings]
+        stats.append((name, len(durations), min(durations),
+                      median(durations), max(durations), sum(durations)))
+    stats.sort(key=lambda stat: stat[4], reverse=True)
+    for stat in stats[0:top]:
+        print("    %-24s %6d %9.2f %9.2f %9.2f %9.2f" % stat)
+    steps = sorted((t for t in timings if t.server is None),
+                   key=lambda t: t.end - t.start, reverse=True)
+    if steps:
+        print("  Slowest cluster steps:")
+        for t in steps[0:top]:
+            print("    %-24s %9.2f" % (t.name, t.end - t.start))
+    print("  Outlier servers (taking more than %sx the median):"
+          % outlier_factor)
+    outliers = []
+    for name, name_timings in sorted(by_name.items()):
+        if len(name_timings) < 2:
+            continue
+        med = median([t.end - t.start for t in name_timings])
+        for t in name_timings:
+            duration = t.end - t.start
+            if duration > med * outlier_factor:
+                outliers.append((duration, med, t))
+    outliers.sort(key=lambda outlier: outlier[0], reverse=True)
+    if not outliers:
+        print("    None.")
+    for duration, med, t in outliers[0:top]:
+        print("    %s %s took %0.2f seconds (median %0.2f)"
+              % (t.server, t.name, duration, med))
+    print("  Critical path:")
+    for t in find_critical_path(timings, graph):
+        where = t.server if t.server is not None else "(cluster)"
+        print("    %9.2f - %9.2f %9.2f %s %s%s" % (
+            t.start, t.end, t.end - t.start, where, t.name,
+            "" if t.ok else " (failed)"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--state",
+                        help="file to read action state"
+                             " information from (default=state.EXT in"
+                             " the current working directory, where EXT"
+                             " depends on the state format)",
+                        default=None, metavar="PATH")
+    parser.add_argument("--state-format",
+                        help="format used to persist action state"
+                             " information (default=%(default)s)",
+                        choices=sorted(storage.STORES.keys()),
+                        default='pickle')
+    parser.add_argument("-c", "--cloud",
+                        help="cloud name to report on (if not provided all"
+                             " clouds are reported on, one at a time)",
+                        default=None)
+    parser.add_argument("--top",
+                        help="show at most this many of the slowest"
+                             " stages/steps and outliers"
+                             " (default=%(default)s)",
+                        type=int, default=10)
+    parser.add_argument("--outlier-factor",
+                        help="servers taking this many times the median"
+                             " (of a stage) are outliers"
+                             " (default=%(default)s)",
+                        type=float, default=2.0)
+    args = parser.parse_args()
+    if not args.state:
+        args.state = os.path.join(
+            os.getcwd(),
+            "state.%s" % storage.STORE_EXTENSIONS[args.state_format])
+    store = storage.open_store(args.state, kind=args.state_format)
+    clouds = store.peek()
+    if args.cloud:
+        cloud_names = [args.cloud]
+    else:
+        cloud_names = sorted(clouds.keys())
+    for cloud_name in cloud_names:
+        run_id, timings, graph = gather_timings(store, cloud_name,
+                                                clouds.get(cloud_name, {}))
+        report(cloud_name, run_id, timings, graph, top=args.top,
+               outlier_factor=args.outlier_factor)
+
+
+if __name__ == '__main__':
+    main()